@@ -0,0 +1,214 @@
+"""Computes the event statistics of novels, used to correlate events with
+canonicity in compute_correlation_large.ipynb
+"""
+import os
+import sys
+import json
+import hashlib
+from collections import Counter
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from prediction_store import PredictionStore
+from util import iter_predictions
+
+NOVEL_DIRECTORY = './data/novels/'
+CACHE_FILENAME = '_statistics_cache.json'
+
+
+def count_tokens(novel_filepath: str) -> int:
+    """Counts the space separated tokens of every line in the .tok file"""
+
+    data = np.fromfile(novel_filepath, dtype=np.uint8)
+    if not data.size:
+        return 0
+
+    # every line has one token more than it has spaces
+    lines = np.count_nonzero(data == ord('\n')) + int(data[-1] != ord('\n'))
+    return np.count_nonzero(data == ord(' ')) + lines
+
+
+def count_events(predictions_filepath: str) -> dict[str, int]:
+    """Counts the predicted tokens per entity of a novel. Uses the columnar
+    store if there is one, and the .predictions.pickle file otherwise.
+    """
+
+    store_dirpath = predictions_filepath.removesuffix('.pickle')
+    if os.path.isdir(store_dirpath):
+        return PredictionStore(store_dirpath).label_counts()
+
+    return Counter(
+        event['entity']
+        for sentence in iter_predictions(predictions_filepath)
+        for event in sentence
+    )
+
+
+def count_novel(filename: str, novel_directory: str = NOVEL_DIRECTORY) -> list[int]:
+    """Returns the token, realis and non-realis counts of a novel"""
+
+    event_count = count_events(novel_directory + filename + '.predictions.pickle')
+
+    return [
+        int(count_tokens(novel_directory + filename + '.tok')),
+        event_count.get('realis', 0),
+        event_count.get('nonrealis', 0),
+    ]
+
+
+def input_filepaths(filename: str, novel_directory: str = NOVEL_DIRECTORY) -> list[str]:
+    """Returns the files that the counts of a novel are computed from"""
+
+    store_dirpath = novel_directory + filename + '.predictions'
+    if os.path.isdir(store_dirpath):
+        predictions_filepaths = [
+            os.path.join(store_dirpath, 'label.npy'),
+            os.path.join(store_dirpath, 'labels.json'),
+        ]
+    else:
+        predictions_filepaths = [store_dirpath + '.pickle']
+
+    return [novel_directory + filename + '.tok', *predictions_filepaths]
+
+
+def fingerprint(filepath: str, cached: list | None = None) -> list[int | str]:
+    """Returns the size, mtime and content hash of a file. The content is only
+    hashed if the size or mtime differ from the cached fingerprint.
+    """
+
+    stat = os.stat(filepath)
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached
+
+    with open(filepath, 'rb') as inp:
+        digest = hashlib.file_digest(inp, 'sha1').hexdigest()
+
+    return [stat.st_size, stat.st_mtime_ns, digest]
+
+
+def count_novel_cached(
+    filename: str, cached: dict | None, novel_directory: str = NOVEL_DIRECTORY
+) -> dict:
+    """Returns the cache entry with the counts of a novel. The novel is only
+    counted again if the content of one of its input files changed.
+    """
+
+    cached = cached or {'fingerprints': {}, 'counts': None}
+    fingerprints = {
+        filepath: fingerprint(filepath, cached['fingerprints'].get(filepath))
+        for filepath in input_filepaths(filename, novel_directory)
+    }
+
+    # a touched file gets a new mtime, but only a new hash means new content
+    counts = cached['counts']
+    if counts is None or any(
+        fingerprints[filepath][::2] != cached['fingerprints'].get(filepath, [])[::2]
+        for filepath in fingerprints
+    ):
+        counts = count_novel(filename, novel_directory)
+
+    return {'fingerprints': fingerprints, 'counts': counts}
+
+
+def load_cache(novel_directory: str = NOVEL_DIRECTORY) -> dict[str, dict]:
+    """Loads the cached counts per novel, or an empty cache if there is none"""
+
+    try:
+        with open(novel_directory + CACHE_FILENAME, 'r', encoding='UTF-8') as inp:
+            return json.load(inp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_cache(cache: dict[str, dict], novel_directory: str = NOVEL_DIRECTORY) -> None:
+    """Writes the cached counts per novel, replacing the old cache at once"""
+
+    cache_filepath = novel_directory + CACHE_FILENAME
+    with open(cache_filepath + '.tmp', 'w', encoding='UTF-8') as outp:
+        json.dump(cache, outp)
+    os.replace(cache_filepath + '.tmp', cache_filepath)
+
+
+def invalidate_statistics(
+    filename: str, novel_directory: str = NOVEL_DIRECTORY
+) -> None:
+    """Removes a novel from the cache, used when its predictions are rewritten"""
+
+    cache = load_cache(novel_directory)
+    if cache.pop(filename, None) is not None:
+        save_cache(cache, novel_directory)
+
+
+def compute_events_distribution(
+    filenames: list[str],
+    novel_directory: str = NOVEL_DIRECTORY,
+    processes: int | None = None,
+    use_cache=True,
+) -> pd.DataFrame:
+    """Of all novels in filenames, compute events/tokens and tokens/events.
+    The novels are counted in parallel by a pool of processes, and the counts
+    are cached in novel_directory so only changed novels are counted again.
+    """
+
+    cache = load_cache(novel_directory) if use_cache else {}
+
+    with Pool(processes) as pool:
+        entries = pool.starmap(
+            partial(count_novel_cached, novel_directory=novel_directory),
+            [(filename, cache.get(filename)) for filename in filenames],
+        )
+
+    if use_cache:
+        cache.update(zip(filenames, entries))
+        save_cache(cache, novel_directory)
+
+    counts = np.array([entry['counts'] for entry in entries], dtype=np.int64).reshape(
+        -1, 3
+    )
+    tokens, realis, nonrealis = counts.T
+    events_total = realis + nonrealis
+
+    # higher realis/non-realis ratio -> relatively more realis events
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pd.DataFrame(
+            {
+                'tokens': tokens,
+                'realis events': realis,
+                'non-realis events': nonrealis,
+                'all_events': events_total,
+                'realis/non-realis ratio': realis / nonrealis,
+                'realis/tokens ratio': realis / tokens,
+                'non-realis/tokens ratio': nonrealis / tokens,
+                'all_events/tokens ratio': events_total / tokens,
+                'tokens/realis distance': tokens / realis,
+                'tokens/non-realis distance': tokens / nonrealis,
+                'tokens/all_events distance': tokens / events_total,
+            },
+            index=filenames,
+        )
+
+
+def main(argv: list[str]) -> None:
+    """Computes the event statistics of the novels in a file with filenames.
+    python3 event_statistics.py file_with_names_of_novels.txt [statistics.csv]
+    the counts are cached in NOVEL_DIRECTORY/_statistics_cache.json
+    """
+
+    if len(argv) < 2:
+        print('provide a file containing filenames of novels', file=sys.stderr)
+        return
+
+    with open(argv[1], 'r', encoding='UTF-8') as inp:
+        filenames = [filename.rstrip() for filename in inp.readlines()]
+
+    statistics = compute_events_distribution(filenames)
+
+    if len(argv) > 2:
+        statistics.to_csv(argv[2])
+    else:
+        print(statistics)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
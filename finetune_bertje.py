@@ -2,25 +2,30 @@
 event prediction
 """
 
-import json
+import os
 import sys
+import json
+import argparse
+import shutil
+import hashlib
 import warnings
 from pprint import pprint
 import threading
 import time
+from collections import deque
 import psutil
-import nvidia_smi
-import evaluate
-from numpy import argmax
-from datasets import Dataset
+import torch
+import numpy as np
+from datasets import Dataset, DatasetDict, load_from_disk
 from transformers import (
     AutoTokenizer,
     DataCollatorForTokenClassification,
     AutoModelForTokenClassification,
     TrainingArguments,
     Trainer,
+    TrainerCallback,
 )
-from util import Annotation
+from util import iter_annotations
 
 # set warning levels
 warnings.simplefilter('ignore')
@@ -28,59 +33,289 @@ warnings.simplefilter('ignore')
 MODEL_NAME = 'GroNLP/bert-base-dutch-cased'
 tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
 data_collator = DataCollatorForTokenClassification(tokenizer=tokenizer)
-seqeval = evaluate.load("seqeval")
 label_list = ['O', 'nonrealis', 'realis']
+TEST_SIZE = 0.25
+SPLIT_SEED = 123
+CACHE_DIRECTORY = './cache/datasets/'
+# bump whenever load_dataset or its preprocessing changes the cached datasets
+CACHE_VERSION = 1
 
-# code used to track resources
-nvidia_smi.nvmlInit()
-gpu_handle = nvidia_smi.nvmlDeviceGetHandleByIndex(0)
-START_TIME = time.time()
+# code used to track resources, the GPU is only probed when training on it
 LOG_FILEPATH = './logs/resource_usage.log'
 LOG_INTERVAL = 1.0
 
 
-def log(message: str, comment=False) -> None:
-    """Appends the log message to LOG_FILEPATH and includes the time"""
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    """Creates an argument parser for the program"""
+    parser = argparse.ArgumentParser(
+        prog='Fine-tune BERTje program',
+        description='Fine-tunes BERTje on the annotations to predict events',
+    )
+
+    parser.add_argument('annotations_filepath', help='Label Studio .json export')
+    parser.add_argument('save_filepath', help='directory to save the model to')
+
+    parser.add_argument(
+        '--log',
+        action='store_true',
+        help=f'write resource usage to {LOG_FILEPATH}',
+    )
+    parser.add_argument(
+        '--log-interval',
+        type=float,
+        default=LOG_INTERVAL,
+        help=f'seconds between resource usage samples (default: {LOG_INTERVAL})',
+    )
+    parser.add_argument(
+        '--no-gpu-log',
+        action='store_true',
+        help='do not log the GPU usage, even when training on the GPU',
+    )
+    parser.add_argument(
+        '--group-by-length',
+        action='store_true',
+        help='batch sentences of a similar number of subwords together',
+    )
 
-    with open(LOG_FILEPATH, 'a', encoding='UTF-8') as outp:
-        if comment:
-            outp.write(f'# {round(time.time() - START_TIME)}\t{message}\n')
-        else:
-            outp.write(f'{round(time.time() - START_TIME)}\t{message}\n')
+    # allow training on hosts without a GPU
+    parser.add_argument(
+        '--cpu',
+        action='store_true',
+        help='train on the CPU, without probing the GPU',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=None,
+        help='number of intra-op threads (default: number of cores)',
+    )
+    parser.add_argument(
+        '--interop-threads',
+        type=int,
+        default=None,
+        help='number of inter-op threads (default: chosen by torch)',
+    )
+    parser.add_argument(
+        '--bf16',
+        choices=['auto', 'on', 'off'],
+        default='auto',
+        help='train in bfloat16 mixed precision, auto enables it on a CPU that '
+        'supports bfloat16 instructions (default: auto)',
+    )
+    parser.add_argument(
+        '--gradient-accumulation-steps',
+        type=int,
+        default=1,
+        help='number of batches to accumulate before updating (default: 1)',
+    )
 
+    args = parser.parse_args(argv[1:])
 
-def track_resources() -> None:
-    """Uses a thread to print the resources to a file every [interval] seconds"""
-    thread = threading.Timer(LOG_INTERVAL, track_resources)
-    thread.daemon = True
-    thread.start()
+    if args.log_interval <= 0:
+        parser.error('--log-interval should be positive')
+    if args.gradient_accumulation_steps < 1:
+        parser.error('--gradient-accumulation-steps should be at least 1')
+    if (args.threads is not None or args.interop_threads is not None) and not args.cpu:
+        parser.error('--threads and --interop-threads require --cpu')
 
-    gpu_usage = nvidia_smi.nvmlDeviceGetUtilizationRates(gpu_handle)
+    return args
 
-    log(
-        f'{psutil.cpu_percent()}\t{psutil.virtual_memory().percent}\t{gpu_usage.gpu}\t{gpu_usage.memory}'
-    )
 
+def cpu_supports_bf16() -> bool:
+    """Checks whether the CPU has bfloat16 instructions (AVX512-BF16 or AMX),
+    without which bfloat16 is emulated and slower than float32
+    """
 
-def load_dataset(filepath: str) -> Dataset:
-    """Converts the label studio json export to a Dataset class"""
+    try:
+        with open('/proc/cpuinfo', 'r', encoding='UTF-8') as inp:
+            flags = next(
+                (
+                    line.split(':', 1)[1].split()
+                    for line in inp
+                    if line.startswith('flags')
+                ),
+                [],
+            )
+    except OSError:
+        return False
+
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def init_gpu_tracking() -> object | None:
+    """Returns the NVML handle of the first GPU, or None if there is no GPU or
+    the NVML bindings are not installed
+    """
 
-    with open(filepath, 'r', encoding='UTF-8') as inp:
-        annotations_json = json.load(inp)
+    # imported here, so the NVML bindings are not needed to train on a CPU
+    try:
+        import nvidia_smi
+    except ImportError as error:
+        print(f'not logging GPU usage: {error}', file=sys.stderr)
+        return None
+
+    try:
+        nvidia_smi.nvmlInit()
+        return nvidia_smi.nvmlDeviceGetHandleByIndex(0)
+    except nvidia_smi.NVMLError as error:
+        print(f'not logging GPU usage: {error}', file=sys.stderr)
+        return None
+
+
+class ResourceSampler(threading.Thread):
+    """Samples the resource usage of this process every interval seconds in
+    one long-lived thread. The samples are kept in a ring buffer and appended
+    to the log file in batches of flush_size samples, as tab separated columns.
+    Events, like the start of a training phase, are written in between as json
+    on lines starting with #.
+    """
 
-    annotations = [Annotation(annotation) for annotation in annotations_json]
-    dataset = Dataset.from_list(
-        [
-            {'id': index, **annotation.get_events_training_data()}
-            for index, annotation in enumerate(annotations)
+    COLUMNS = ['time', 'RSS MB', 'CPU user', 'CPU system', 'read MB', 'write MB']
+    GPU_COLUMNS = ['GPU', 'GPU MEM']
+
+    def __init__(
+        self,
+        filepath: str = LOG_FILEPATH,
+        interval: float = LOG_INTERVAL,
+        flush_size: int = 60,
+        gpu_handle: object | None = None,
+    ):
+        super().__init__(daemon=True)
+        self.filepath = filepath
+        self.interval = interval
+        self.flush_size = flush_size
+        self.gpu_handle = gpu_handle
+        self.columns = self.COLUMNS + (
+            self.GPU_COLUMNS if gpu_handle is not None else []
+        )
+
+        self.process = psutil.Process()
+        self.buffer = np.full((2 * flush_size, len(self.columns)), np.nan)
+        self.sample_count = 0
+        self.flushed_count = 0
+        self.events = deque()
+        self.stopped = threading.Event()
+        self.start_time = time.perf_counter()
+
+    def __enter__(self) -> 'ResourceSampler':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """Resets the log file and starts sampling"""
+        with open(self.filepath, 'w', encoding='UTF-8') as outp:
+            outp.write('\t'.join(self.columns) + '\n')
+        self.start_time = time.perf_counter()
+        super().start()
+
+    def stop(self) -> None:
+        """Stops sampling and writes the remaining samples and events"""
+        self.stopped.set()
+        self.join()
+
+    def mark(self, event: str, **fields) -> None:
+        """Records an event, which is written with the next batch of samples"""
+        self.events.append(
+            {'time': round(time.perf_counter() - self.start_time, 3), 'event': event}
+            | fields
+        )
+
+    def sample(self) -> None:
+        """Adds the current resource usage of the process to the ring buffer"""
+        row = self.buffer[self.sample_count % len(self.buffer)]
+        row[0] = time.perf_counter() - self.start_time
+
+        with self.process.oneshot():
+            row[1] = self.process.memory_info().rss / 1e6
+            row[2:4] = self.process.cpu_times()[:2]
+            # io counters are not available on every platform
+            if hasattr(self.process, 'io_counters'):
+                io_counters = self.process.io_counters()
+                row[4:6] = io_counters.read_bytes / 1e6, io_counters.write_bytes / 1e6
+
+        if self.gpu_handle is not None:
+            # already imported by init_gpu_tracking, which gave the handle
+            import nvidia_smi
+
+            gpu_usage = nvidia_smi.nvmlDeviceGetUtilizationRates(self.gpu_handle)
+            row[6:8] = gpu_usage.gpu, gpu_usage.memory
+
+        self.sample_count += 1
+
+    def flush(self) -> None:
+        """Appends the unwritten samples and events to the log file in order"""
+        rows = [
+            self.buffer[sample_no % len(self.buffer)]
+            for sample_no in range(self.flushed_count, self.sample_count)
         ]
+        self.flushed_count = self.sample_count
+
+        with open(self.filepath, 'a', encoding='UTF-8') as outp:
+            for row in rows:
+                while self.events and self.events[0]['time'] <= row[0]:
+                    outp.write(f'# {json.dumps(self.events.popleft())}\n')
+                outp.write('\t'.join(f'{value:.6g}' for value in row) + '\n')
+            while self.events:
+                outp.write(f'# {json.dumps(self.events.popleft())}\n')
+
+    def run(self) -> None:
+        """Samples every interval seconds until the sampler is stopped"""
+        while not self.stopped.wait(self.interval):
+            self.sample()
+            if self.sample_count - self.flushed_count >= self.flush_size:
+                self.flush()
+
+        self.sample()
+        self.flush()
+
+
+def dataset_cache_key(filepath: str) -> str:
+    """Hashes everything the tokenized dataset depends on: the annotations
+    file, the tokenizer, the split, the labels and the preprocessing code
+    """
+
+    with open(filepath, 'rb') as inp:
+        digest = hashlib.file_digest(inp, 'sha1')
+    digest.update(
+        json.dumps(
+            [CACHE_VERSION, MODEL_NAME, TEST_SIZE, SPLIT_SEED, label_list]
+        ).encode()
     )
 
-    dataset = dataset.train_test_split(test_size=0.25, seed=123)
+    return digest.hexdigest()
+
+
+def load_dataset(filepath: str) -> DatasetDict:
+    """Converts the label studio json export to a Dataset class.
+    The tokenized dataset is saved in CACHE_DIRECTORY, and memory-mapped from
+    there when the annotations, tokenizer, split and labels are the same.
+    """
+
+    cache_dirpath = os.path.join(CACHE_DIRECTORY, dataset_cache_key(filepath))
+    if os.path.isdir(cache_dirpath):
+        return load_from_disk(cache_dirpath)
+
+    with open(filepath, 'r', encoding='UTF-8') as inp:
+        dataset = Dataset.from_list(
+            [
+                {'id': index, **annotation.get_events_training_data()}
+                for index, annotation in enumerate(iter_annotations(inp))
+            ]
+        )
+
+    dataset = dataset.train_test_split(test_size=TEST_SIZE, seed=SPLIT_SEED)
 
     tokenized_dataset = dataset.map(pre_process_data, batched=True)
 
-    return tokenized_dataset
+    # write to a temporary directory so a cache is never half written
+    shutil.rmtree(cache_dirpath + '.tmp', ignore_errors=True)
+    tokenized_dataset.save_to_disk(cache_dirpath + '.tmp')
+    os.replace(cache_dirpath + '.tmp', cache_dirpath)
+
+    return load_from_disk(cache_dirpath)
 
 
 def pre_process_data(examples: dict[str, list]) -> dict[str, list]:
@@ -110,22 +345,119 @@ def pre_process_data(examples: dict[str, list]) -> dict[str, list]:
     return tokenized_inputs
 
 
+def true_label_ids(
+    predictions: np.ndarray, labels: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Removes the ignored positions (special tokens and subwords) of the
+    predicted and true label ids, and joins the sentences separated by an 'O',
+    like seqeval joins the sentences.
+    """
+
+    separator = np.full((len(labels), 1), label_list.index('O'))
+    kept = np.hstack([labels != -100, np.ones_like(separator, dtype=bool)])
+
+    return (
+        np.hstack([predictions, separator])[kept],
+        np.hstack([labels, separator])[kept],
+    )
+
+
+def entity_spans(label_ids: np.ndarray) -> np.ndarray:
+    """Returns the start, end and label id of every entity, as rows.
+    The labels have no B-/I- prefix, so seqeval takes every run of the same
+    label as one entity.
+    """
+
+    outside = label_ids == label_list.index('O')
+    starts = ~outside & (label_ids != np.r_[-1, label_ids[:-1]])
+    ends = ~outside & (label_ids != np.r_[label_ids[1:], -1])
+
+    return np.column_stack(
+        [np.flatnonzero(starts), np.flatnonzero(ends), label_ids[starts]]
+    )
+
+
+def entity_type(label: str) -> str:
+    """Returns the entity type that seqeval reports for a label.
+    The first character is taken as the B/I tag, so 'realis' becomes 'ealis'.
+    """
+
+    return label[1:].split('-', maxsplit=1)[-1] or '_'
+
+
+def precision_recall_f1(
+    tp_sum: np.ndarray, pred_sum: np.ndarray, true_sum: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Computes the precision, recall and f1 from the counts of correct,
+    predicted and true entities, and gives 0 where they are undefined
+    """
+
+    precision = tp_sum / np.where(pred_sum == 0, 1, pred_sum)
+    recall = tp_sum / np.where(true_sum == 0, 1, true_sum)
+    denominator = precision + recall
+    denominator[denominator == 0.0] = 1
+
+    return precision, recall, 2 * precision * recall / denominator
+
+
+def compute_scores(predictions: np.ndarray, labels: np.ndarray) -> dict:
+    """Computes the span-level precision, recall and f1 per entity type and
+    overall, and the token accuracy, from the argmax of the logits and the
+    label ids. Gives the same results as seqeval.compute.
+    """
+
+    predicted_ids, true_ids = true_label_ids(predictions, labels)
+    predicted_spans = entity_spans(predicted_ids)
+    true_spans = entity_spans(true_ids)
+
+    # encode every span as one number, to find the matching spans at once
+    encoding = np.array([len(true_ids) * len(label_list), len(label_list), 1])
+    correct = np.intersect1d(predicted_spans @ encoding, true_spans @ encoding)
+
+    n_labels = len(label_list)
+    tp_sum = np.bincount(correct % n_labels, minlength=n_labels)
+    pred_sum = np.bincount(predicted_spans[:, 2], minlength=n_labels)
+    true_sum = np.bincount(true_spans[:, 2], minlength=n_labels)
+
+    # seqeval reports the types that are predicted or true, sorted by name
+    label_ids = sorted(
+        np.flatnonzero(pred_sum + true_sum), key=lambda i: entity_type(label_list[i])
+    )
+    results = {}
+    for label_id, precision, recall, f1 in zip(
+        label_ids,
+        *precision_recall_f1(
+            tp_sum[label_ids], pred_sum[label_ids], true_sum[label_ids]
+        ),
+    ):
+        results[entity_type(label_list[label_id])] = {
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'number': true_sum[label_id],
+        }
+
+    overall = precision_recall_f1(
+        tp_sum.sum(keepdims=True),
+        pred_sum.sum(keepdims=True),
+        true_sum.sum(keepdims=True),
+    )
+    results['overall_precision'] = overall[0][0]
+    results['overall_recall'] = overall[1][0]
+    results['overall_f1'] = overall[2][0]
+    kept = labels != -100
+    results['overall_accuracy'] = int(
+        np.count_nonzero(kept & (predictions == labels))
+    ) / int(np.count_nonzero(kept))
+
+    return results
+
+
 def compute_metrics(p):
-    """Uses seqval to compute metrics while fine-tuning the model"""
+    """Computes the metrics of the predictions while fine-tuning the model"""
     predictions, labels = p
-    predictions = argmax(predictions, axis=2)
-
-    # Remove ignored index (special tokens)
-    true_predictions = [
-        [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
-        for prediction, label in zip(predictions, labels)
-    ]
-    true_labels = [
-        [label_list[l] for (p, l) in zip(prediction, label) if l != -100]
-        for prediction, label in zip(predictions, labels)
-    ]
-
-    results = seqeval.compute(predictions=true_predictions, references=true_labels)
+    results = compute_scores(np.argmax(predictions, axis=2), labels)
+
     return {
         "precision": results["overall_precision"],
         "recall": results["overall_recall"],
@@ -152,8 +484,63 @@ def init_model() -> AutoModelForTokenClassification:
     return model
 
 
-def fine_tune_model(dataset: Dataset, save_filepath: str) -> Trainer:
-    """Fine-tunes the model using the dataset, and saves the model to the path"""
+class PaddingCollator:
+    """Wraps a data collator to count the real and the padded tokens of the
+    batches it creates
+    """
+
+    def __init__(self, collator: DataCollatorForTokenClassification):
+        self.collator = collator
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def __call__(self, features: list[dict]) -> dict:
+        batch = self.collator(features)
+        self.tokens += int(batch['attention_mask'].sum())
+        self.padded_tokens += batch['attention_mask'].numel()
+        return batch
+
+
+class ThroughputCallback(TrainerCallback):
+    """Logs the wall-clock time, the training tokens per second and the ratio
+    of padding tokens of every epoch, using the counts of a PaddingCollator
+    """
+
+    def __init__(self, collator: PaddingCollator):
+        self.collator = collator
+        self.start_time = time.perf_counter()
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.collator.tokens, self.collator.padded_tokens = 0, 0
+        self.start_time = time.perf_counter()
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        seconds = time.perf_counter() - self.start_time
+        padding = self.collator.padded_tokens - self.collator.tokens
+        metrics = {
+            'epoch': state.epoch,
+            'train_epoch_seconds': seconds,
+            'train_tokens_per_second': self.collator.tokens / seconds,
+            'train_padding_ratio': padding / max(self.collator.padded_tokens, 1),
+        }
+        state.log_history.append(metrics)
+        print(metrics)
+
+
+def fine_tune_model(
+    dataset: Dataset,
+    save_filepath: str,
+    group_by_length=False,
+    cpu=False,
+    bf16=False,
+    gradient_accumulation_steps=1,
+) -> Trainer:
+    """Fine-tunes the model using the dataset, and saves the model to the path.
+    With group_by_length, batches contain sentences of a similar number of
+    subwords (still shuffled with the seed), so they need less padding.
+    With gradient_accumulation_steps, the effective batch size is multiplied
+    without using more memory.
+    """
 
     training_args = TrainingArguments(
         output_dir='models/intermediate',
@@ -164,12 +551,17 @@ def fine_tune_model(dataset: Dataset, save_filepath: str) -> Trainer:
         # per_device_eval_batch_size=16,
         # num_train_epochs=4,
         # weight_decay=0.01,
-        no_cuda=False,
+        no_cuda=cpu,
+        bf16=bf16,
+        gradient_accumulation_steps=gradient_accumulation_steps,
         evaluation_strategy="epoch",
         save_strategy="epoch",
         load_best_model_at_end=True,
+        group_by_length=group_by_length,
     )
 
+    padding_collator = PaddingCollator(data_collator)
+
     trainer = Trainer(
         model_init=init_model,
         # model=model,
@@ -177,8 +569,9 @@ def fine_tune_model(dataset: Dataset, save_filepath: str) -> Trainer:
         train_dataset=dataset['train'],
         eval_dataset=dataset['test'],
         tokenizer=tokenizer,
-        data_collator=data_collator,
+        data_collator=padding_collator,
         compute_metrics=compute_metrics,
+        callbacks=[ThroughputCallback(padding_collator)],
     )
 
     trainer.train()
@@ -193,19 +586,7 @@ def evaluate_model(
     """Uses the test set of the dataset to evaluate the model"""
 
     predictions, labels, _ = trainer.predict(dataset['test'])
-    predictions = argmax(predictions, axis=2)
-
-    # Remove ignored index (special tokens)
-    true_predictions = [
-        [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
-        for prediction, label in zip(predictions, labels)
-    ]
-    true_labels = [
-        [label_list[l] for (p, l) in zip(prediction, label) if l != -100]
-        for prediction, label in zip(predictions, labels)
-    ]
-
-    results = seqeval.compute(predictions=true_predictions, references=true_labels)
+    results = compute_scores(np.argmax(predictions, axis=2), labels)
 
     if print_results:
         print('\nThese are the results of the test set per event type:')
@@ -217,31 +598,56 @@ def evaluate_model(
 def main(argv: list[str]):
     """Loads the annotations, fine-tunes the model, and saved the new model.
     $ python3 finetune_bertje.py annotations.json models/finetuned_bertje/
-    add --log as a third argument to write resource logs to a file
+    add --log [--log-interval 0.5] [--no-gpu-log] to write resource logs to a file
+    add --group-by-length to batch sentences of a similar length together
+    add --cpu [--threads 16] [--interop-threads 2] to train without a GPU
+    add --gradient-accumulation-steps 4 to update once every 4 batches
     """
 
-    if len(argv) < 3:
-        print('give an input- and output filename as arguments and try again')
-        return
+    args = parse_args(argv)
+
+    if args.cpu:
+        # must be set before torch runs any parallel work
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+        if args.interop_threads is not None:
+            torch.set_num_interop_threads(args.interop_threads)
+        bf16 = args.bf16 == 'on' or (args.bf16 == 'auto' and cpu_supports_bf16())
+        print(
+            f'training on the CPU with {torch.get_num_threads()} intra-op and '
+            f'{torch.get_num_interop_threads()} inter-op threads, bf16={bf16}'
+        )
+    else:
+        bf16 = args.bf16 == 'on'
 
-    if len(argv) == 4 and argv[3].strip() == '--log':
-        # reset file
-        with open(LOG_FILEPATH, 'w', encoding='UTF-8') as outp:
-            outp.write('time\tCPU\tMEM\tGPU\tGPU MEM\n')
-        track_resources()
+    training_kwargs = {
+        'group_by_length': args.group_by_length,
+        'cpu': args.cpu,
+        'bf16': bf16,
+        'gradient_accumulation_steps': args.gradient_accumulation_steps,
+    }
 
-        log('[load dataset]', comment=True)
-        dataset = load_dataset(argv[1])
+    if args.log:
+        log_gpu = not args.cpu and not args.no_gpu_log
+        gpu_handle = init_gpu_tracking() if log_gpu else None
 
-        log('[train]', comment=True)
-        trainer = fine_tune_model(dataset, argv[2])
+        with ResourceSampler(
+            LOG_FILEPATH, args.log_interval, gpu_handle=gpu_handle
+        ) as sampler:
+            sampler.mark('phase', phase='load dataset')
+            dataset = load_dataset(args.annotations_filepath)
 
-        log('[predict & evaluate]', comment=True)
-        evaluation_result = evaluate_model(trainer, dataset)
+            sampler.mark('phase', phase='train')
+            trainer = fine_tune_model(dataset, args.save_filepath, **training_kwargs)
+
+            sampler.mark('phase', phase='predict & evaluate')
+            evaluation_result = evaluate_model(trainer, dataset)
+
+            sampler.mark('phase', phase='done')
 
     else:
-        dataset = load_dataset(argv[1])
-        trainer = fine_tune_model(dataset, argv[2])
+        dataset = load_dataset(args.annotations_filepath)
+        trainer = fine_tune_model(dataset, args.save_filepath, **training_kwargs)
         evaluation_result = evaluate_model(trainer, dataset)
 
 
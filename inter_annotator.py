@@ -1,10 +1,23 @@
 """Uses the Annotation class to compute inter annotator agreement"""
 import argparse
+import csv
 import json
+import os
+from collections.abc import Iterator
 from io import TextIOWrapper
 from statistics import fmean
-from itertools import combinations
-from util import Annotation
+from itertools import combinations, permutations
+from multiprocessing import Pool
+import numpy as np
+from util import Annotation, iter_annotations
+
+# the categories of annotations, and the groups of categories in the matrix
+CATEGORIES = ['realis', 'nonrealis', 'agent', 'patient', 'sep_verb_particle']
+CATEGORY_GROUPS = {
+    'events': ['realis', 'nonrealis'],
+    'mentions': ['agent', 'patient'],
+    **{category: [category] for category in CATEGORIES},
+}
 
 
 def parse_args() -> argparse.Namespace:
@@ -45,6 +58,34 @@ def parse_args() -> argparse.Namespace:
     )
     group2._group_actions.append(mentions)
 
+    # allow exporting the agreement of every pair per category
+    parser.add_argument(
+        '--matrix',
+        metavar='FILEPATH',
+        help='write the pairwise agreement per category to a .csv or .json file',
+    )
+
+    # allow computing bootstrap confidence intervals of the scores
+    parser.add_argument(
+        '--bootstrap',
+        type=int,
+        default=0,
+        metavar='RESAMPLES',
+        help='compute bootstrap confidence intervals with this many resamples',
+    )
+    parser.add_argument(
+        '--confidence',
+        type=float,
+        default=0.95,
+        help='confidence level of the bootstrap intervals (default: 0.95)',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=123,
+        help='seed of the bootstrap resampling (default: 123)',
+    )
+
     args = parser.parse_args()
 
     # error if not enough files are provided
@@ -58,28 +99,115 @@ def parse_args() -> argparse.Namespace:
         if not filepath.name.endswith('.json'):
             parser.error('The annotation files should be .json format')
 
+    if args.bootstrap < 0 or not 0 < args.confidence < 1:
+        parser.error(
+            'The number of resamples cannot be negative and the confidence '
+            'should be between 0 and 1'
+        )
+
+    if args.matrix is not None and not args.matrix.endswith(('.csv', '.json')):
+        parser.error('The agreement matrix can only be written to .csv or .json')
+
     return args
 
 
+def align_annotations(
+    all_annotations: list[list[Annotation]],
+) -> tuple[list[list[Annotation]], list[list[Annotation]]]:
+    """Joins the annotations of all annotators on the randomid and sentid of
+    their task, in the order of the first annotator. Returns the aligned
+    annotations, and the unmatched annotations of every annotator.
+    """
+
+    indices = [
+        {
+            (annotation.random_id, annotation.sent_id): annotation
+            for annotation in annotations
+        }
+        for annotations in all_annotations
+    ]
+
+    shared_keys = [
+        key for key in indices[0] if all(key in index for index in indices[1:])
+    ]
+    shared = set(shared_keys)
+
+    aligned = [[index[key] for key in shared_keys] for index in indices]
+    unmatched = [
+        [annotation for key, annotation in index.items() if key not in shared]
+        for index in indices
+    ]
+
+    return aligned, unmatched
+
+
 def load_annotations(files: list[TextIOWrapper]) -> list[list[Annotation]]:
-    """Loads all the annotations and checks if they are equal in length"""
+    """Loads all the annotations and aligns them on their task, so the
+    agreement is only computed over the tasks that all annotators annotated
+    """
     all_annotations = []
     for file in files:
-        annotations_json = json.load(file)
+        all_annotations.append(list(iter_annotations(file)))
         file.close()
 
-        all_annotations.append(
-            [Annotation(annotation) for annotation in annotations_json]
-        )
+    aligned, unmatched = align_annotations(all_annotations)
 
-    # check if all of them are equal in length
-    annotation_lengths = [len(annotations) for annotations in all_annotations]
-    if not all(annotation_lengths):
-        raise IndexError(
-            f'Not all files have the same number of annotations: {annotation_lengths}'
-        )
+    # report the tasks that are not annotated by every annotator
+    for file, annotations, unmatched_annotations in zip(
+        files, all_annotations, unmatched
+    ):
+        if len(annotations) != len({(a.random_id, a.sent_id) for a in annotations}):
+            print(f'{file.name} contains duplicate tasks, only the last is used')
+        if unmatched_annotations:
+            print(
+                f'{file.name} has {len(unmatched_annotations)} tasks that not all '
+                'annotators annotated: '
+                + ', '.join(str(a.random_id) for a in unmatched_annotations)
+            )
+
+    if not aligned[0]:
+        raise IndexError('The annotation files do not have any tasks in common')
+
+    return aligned
 
-    return all_annotations
+
+def pair_sentence_counts(
+    annotations: list[list[Annotation]],
+    only_mentions: bool = False,
+    only_events: bool = False,
+    no_sep_particle: bool = False,
+) -> np.ndarray:
+    """Counts the TP/FP/FN of every sentence for every pair of annotators.
+    Returns an array of pairs x sentences x (tp, fp, fn)
+    """
+
+    # compute the sets of every annotator once, instead of once per pair
+    annotation_sets = [
+        [
+            annotation.get_annotations_set(
+                only_mentions=only_mentions,
+                only_events=only_events,
+                no_sep_particle=no_sep_particle,
+            )
+            for annotation in annotator_annotations
+        ]
+        for annotator_annotations in annotations
+    ]
+
+    return np.array(
+        [
+            [
+                (
+                    len(annotations1_set & annotations2_set),
+                    len(annotations2_set - annotations1_set),
+                    len(annotations1_set - annotations2_set),
+                )
+                for annotations1_set, annotations2_set in zip(combi[0], combi[1])
+            ]
+            for combi in combinations(annotation_sets, 2)
+        ],
+        dtype=np.int64,
+    ).reshape(-1, min(map(len, annotations)), 3)
 
 
 def compute_inter_annotator(
@@ -87,29 +215,24 @@ def compute_inter_annotator(
     only_mentions: bool = False,
     only_events: bool = False,
     no_sep_particle: bool = False,
+    counts: np.ndarray | None = None,
 ) -> dict[str, dict[str, float]]:
     """Compute the inter annotator agreement of all annotations.
-    Can also only compute for specific annotations."""
+    Can also only compute for specific annotations. The counts of
+    pair_sentence_counts are computed if they are not given."""
 
     precision, recall, f1 = [], [], []
 
-    for combi in combinations(annotations, 2):
-        tp, fp, fn = 0, 0, 0
-        for annotations1, annotations2 in zip(combi[0], combi[1]):
-            annotations1_set = annotations1.get_annotations_set(
-                only_mentions=only_mentions,
-                only_events=only_events,
-                no_sep_particle=no_sep_particle,
-            )
-            annotations2_set = annotations2.get_annotations_set(
-                only_mentions=only_mentions,
-                only_events=only_events,
-                no_sep_particle=no_sep_particle,
-            )
+    if counts is None:
+        counts = pair_sentence_counts(
+            annotations,
+            only_mentions=only_mentions,
+            only_events=only_events,
+            no_sep_particle=no_sep_particle,
+        )
 
-            tp += len(annotations1_set & annotations2_set)
-            fp += len(annotations2_set - annotations1_set)
-            fn += len(annotations1_set - annotations2_set)
+    for pair_counts in counts:
+        tp, fp, fn = pair_counts.sum(axis=0).tolist()
 
         precision.append(tp / (tp + fp) if tp + fp > 0 else 0)
         recall.append(tp / (tp + fn) if tp + fn > 0 else 0)
@@ -126,6 +249,179 @@ def compute_inter_annotator(
     }
 
 
+def bootstrap_scores(
+    counts: np.ndarray, resamples: int, seed: np.random.SeedSequence
+) -> np.ndarray:
+    """Resamples the sentences with replacement and computes the precision,
+    recall and f1-score averaged over the pairs for every resample.
+    Returns an array of resamples x (precision, recall, f1-score)
+    """
+
+    rng = np.random.default_rng(seed)
+    sentence_count = counts.shape[1]
+
+    # how often every sentence is drawn in every resample
+    weights = rng.multinomial(
+        sentence_count, np.full(sentence_count, 1 / sentence_count), size=resamples
+    )
+    tp, fp, fn = np.moveaxis(weights @ counts, -1, 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0)
+        f1 = np.where(
+            precision + recall > 0,
+            (2 * precision * recall) / (precision + recall),
+            0,
+        )
+
+    # average over the pairs, like compute_inter_annotator
+    return np.stack([precision, recall, f1], axis=-1).mean(axis=0)
+
+
+def compute_bootstrap_intervals(
+    counts: np.ndarray,
+    resamples: int = 1000,
+    confidence: float = 0.95,
+    seed: int = 123,
+    processes: int | None = None,
+) -> dict[str, tuple[float, float]]:
+    """Computes bootstrap confidence intervals of the precision, recall and
+    f1-score from the per-sentence counts of pair_sentence_counts. The
+    resamples are drawn in chunks by a pool of processes, and every chunk
+    has its own seed, so the intervals only depend on the seed.
+    """
+
+    chunk_size = 100
+    chunk_sizes = [
+        min(chunk_size, resamples - start) for start in range(0, resamples, chunk_size)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+    with Pool(processes) as pool:
+        scores = np.concatenate(
+            pool.starmap(
+                bootstrap_scores,
+                [
+                    (counts, size, chunk_seed)
+                    for size, chunk_seed in zip(chunk_sizes, seeds)
+                ],
+            )
+        )
+
+    bounds = np.quantile(scores, [(1 - confidence) / 2, (1 + confidence) / 2], axis=0)
+
+    return {
+        name: (float(bounds[0, index]), float(bounds[1, index]))
+        for index, name in enumerate(['precision', 'recall', 'f1-score'])
+    }
+
+
+def annotation_items(annotation: Annotation) -> Iterator[tuple[str, tuple]]:
+    """Yields every annotation of a sentence together with its category"""
+
+    for index, event in annotation.events.items():
+        yield event.type.name.lower(), (index, event.type)
+        if event.separate_verb_particle:
+            yield 'sep_verb_particle', (index,)
+
+    for index, mention in annotation.mentions.items():
+        for event in mention.to_event:
+            yield mention.type.name.lower(), (index, mention.type, event)
+
+
+def encode_annotations(
+    annotations: list[list[Annotation]],
+) -> tuple[list[np.ndarray], np.ndarray]:
+    """Gives every distinct annotation of a sentence an integer id. Returns the
+    sorted ids of every annotator, and the category index of every id
+    """
+
+    ids = {}
+    categories = []
+    annotator_ids = [[] for _ in annotations]
+    for sentno, sentence_annotations in enumerate(zip(*annotations)):
+        for annotator, annotation in enumerate(sentence_annotations):
+            for category, item in annotation_items(annotation):
+                key = (sentno, category, item)
+                if key not in ids:
+                    ids[key] = len(ids)
+                    categories.append(CATEGORIES.index(category))
+                annotator_ids[annotator].append(ids[key])
+
+    return [
+        np.unique(np.array(item_ids, dtype=np.int64)) for item_ids in annotator_ids
+    ], np.array(categories, dtype=np.int64)
+
+
+def compute_agreement_matrix(
+    annotations: list[list[Annotation]], annotators: list[str]
+) -> list[dict[str, str | int | float]]:
+    """Computes the TP/FP/FN and scores of every ordered pair of annotators
+    for every category of annotations, taking the first as the reference
+    """
+
+    annotator_ids, categories = encode_annotations(annotations)
+
+    rows = []
+    for group, group_categories in CATEGORY_GROUPS.items():
+        in_group = np.isin(categories, [CATEGORIES.index(c) for c in group_categories])
+        selected = [item_ids[in_group[item_ids]] for item_ids in annotator_ids]
+
+        # tp[a, b] is the number of annotations a and b have in common
+        tp = np.array(
+            [
+                [
+                    np.intersect1d(item_ids1, item_ids2, assume_unique=True).size
+                    for item_ids2 in selected
+                ]
+                for item_ids1 in selected
+            ],
+            dtype=np.int64,
+        )
+        counts = np.array([item_ids.size for item_ids in selected], dtype=np.int64)
+        fp = counts[np.newaxis, :] - tp
+        fn = counts[:, np.newaxis] - tp
+
+        for annotator1, annotator2 in permutations(range(len(annotators)), 2):
+            pair_tp, pair_fp, pair_fn = (
+                int(matrix[annotator1, annotator2]) for matrix in (tp, fp, fn)
+            )
+            precision = pair_tp / (pair_tp + pair_fp) if pair_tp + pair_fp > 0 else 0
+            recall = pair_tp / (pair_tp + pair_fn) if pair_tp + pair_fn > 0 else 0
+            rows.append(
+                {
+                    'annotator1': annotators[annotator1],
+                    'annotator2': annotators[annotator2],
+                    'category': group,
+                    'tp': pair_tp,
+                    'fp': pair_fp,
+                    'fn': pair_fn,
+                    'precision': precision,
+                    'recall': recall,
+                    'f1-score': (2 * precision * recall) / (precision + recall)
+                    if precision + recall > 0
+                    else 0,
+                }
+            )
+
+    return rows
+
+
+def write_agreement_matrix(
+    rows: list[dict[str, str | int | float]], filepath: str
+) -> None:
+    """Writes the rows of the agreement matrix to a .csv or .json file"""
+
+    with open(filepath, 'w', encoding='UTF-8', newline='') as outp:
+        if filepath.endswith('.json'):
+            json.dump(rows, outp, indent=4)
+        else:
+            writer = csv.DictWriter(outp, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
 def main():
     """Computes an inter annotator score based on the command line input"""
 
@@ -133,18 +429,48 @@ def main():
 
     annotations = load_annotations(args.annotation_filepaths)
 
-    scores = compute_inter_annotator(
+    # the per-sentence counts are used for the scores and the bootstrap
+    counts = pair_sentence_counts(
         annotations,
         only_mentions=args.only_mentions,
         only_events=args.only_events,
         no_sep_particle=args.no_sep_particle,
     )
+    scores = compute_inter_annotator(annotations, counts=counts)
 
     print('\nThese are the final scores (averages if num annotators > 2):')
     print(
         f'f1-score: {scores["f1-score"]:.3f} | precision: {scores["precision"]:.3f} | recall: {scores["recall"]:.3f}\n'
     )
 
+    if args.bootstrap:
+        intervals = compute_bootstrap_intervals(
+            counts,
+            resamples=args.bootstrap,
+            confidence=args.confidence,
+            seed=args.seed,
+        )
+        print(
+            f'{args.confidence:.0%} confidence intervals '
+            f'({args.bootstrap} bootstrap resamples, seed {args.seed}):'
+        )
+        print(
+            ' | '.join(
+                f'{name}: {lower:.3f}-{upper:.3f}'
+                for name, (lower, upper) in intervals.items()
+            ),
+            end='\n\n',
+        )
+
+    # compute the agreement of every pair and category from the same parse
+    if args.matrix is not None:
+        rows = compute_agreement_matrix(
+            annotations,
+            [os.path.basename(file.name) for file in args.annotation_filepaths],
+        )
+        write_agreement_matrix(rows, args.matrix)
+        print(f'Wrote the agreement matrix to \'{args.matrix}\'')
+
 
 if __name__ == '__main__':
     main()
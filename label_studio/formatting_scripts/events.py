@@ -3,12 +3,20 @@ import os
 import sys
 import json
 import random
+import argparse
+from array import array
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
 from xml.etree import ElementTree
+import numpy as np
 import pandas as pd
 from .util import Index
-
 from pprint import pprint
 
+# amount of sentences before and after a sentence that are shown as context
+CONTEXT_WIDTH = 2
+
 
 # def split_clauses(sentid, novel_name):
 #     """Uses grammatical rules to split clauses into multiple lines"""
@@ -71,93 +79,125 @@ from pprint import pprint
 #     return '\n'.join(clauses)
 
 
-def get_context(novel_text, sentno):
-    """Returns novel[sentno], except if this is out of range.
-    Then [no context] is returned
+def parse_novel_sents(novel_text):
+    """Splits every line of a novel once into its sentence id and text
 
-    novel_text: list[str]
-    sentno: int
+    novel_text: list[str] -- lines of a .tok file
+
+    return -> (list of sentids, list of texts as in the line, list of texts
+        without trailing whitespace)
+    """
+    sentids, texts, stripped_texts = [], [], []
+    for line in novel_text:
+        sentid, text = line.split('|', 1)
+        sentids.append(sentid)
+        texts.append(text)
+        stripped_texts.append(text.rstrip())
+    return sentids, texts, stripped_texts
+
+
+def context_windows(texts, context_width=CONTEXT_WIDTH):
+    """Returns a sliding view of the sentences around every sentence: row i
+    holds the context_width sentences before sentence i, sentence i, and the
+    context_width sentences after it. Missing sentences are [no context].
+
+    texts: list[str]
+    context_width: int
 
-    return -> str
+    return -> array of str with a row of 2 * context_width + 1 per sentence
     """
-    if sentno < 0:
-        return "[no context]"
-    if sentno >= len(novel_text):
-        return "[no context]"
-    # base case, strip sentence of start identifier
-    return novel_text[sentno].split('|', 1)[1].rstrip()
+    padding = ['[no context]'] * context_width
+    padded_texts = np.array(padding + texts + padding, dtype=object)
+    return np.lib.stride_tricks.sliding_window_view(
+        padded_texts, 2 * context_width + 1)
 
 
-def novel_sents_to_tasks(novel_name, novel_text):
+def novel_sents_to_tasks(novel_name, novel_text, context_width=CONTEXT_WIDTH):
     """Creates a task for each sentence in novel in the json format required
     for label studio.
 
     novel_name: str
     novel_text: list[str]
+    context_width: int -- amount of sentences of context before and after
 
     return -> tasks in label-studio json format
     """
+    author, title = novel_name.split('_', 1)
+    sentids, texts, stripped_texts = parse_novel_sents(novel_text)
+    windows = context_windows(stripped_texts, context_width)
+
+    pre_context_names = [f'pre_context{distance}'
+                         for distance in range(context_width, 0, -1)]
+    post_context_names = [f'post_context{distance}'
+                          for distance in range(1, context_width + 1)]
+
     novel_tasks = []
-    for sentno, sentence in enumerate(novel_text):
-        author, title = novel_name.split('_', 1)
-        sentid, text = sentence.rstrip().split('|', 1)
+    for sentid, text, stripped_text, window in zip(
+            sentids, texts, stripped_texts, windows):
         data = {
             # 'index': sentno,
             'sentid': sentid,
             'author': author,
             'title': title,
             'randomid': None,
-            'text_len': text.count(' ') + 1,
-            'pre_context2': get_context(novel_text, sentno - 2),
-            'pre_context1': get_context(novel_text, sentno - 1),
-            'text': sentence.split('|')[1],
-            'post_context1': get_context(novel_text, sentno + 1),
-            'post_context2': get_context(novel_text, sentno + 2)
+            'text_len': stripped_text.count(' ') + 1,
+            **dict(zip(pre_context_names, window[:context_width])),
+            'text': text,
+            **dict(zip(post_context_names, window[context_width + 1:])),
         }
         novel_tasks.append({'data': data, 'predictions': [{'result': []}]})
     return novel_tasks
 
 
-def create_novel_events_tasks(novel_name):
+def create_novel_events_tasks(novel_name, context_width=CONTEXT_WIDTH):
     """Creates the tasks for one novel"""
     with open(f'./openboek-main/tokenized/{novel_name}.tok',
               'r', encoding='utf-8') as inp:
         novel_text = inp.readlines()
 
-    novel_tasks = novel_sents_to_tasks(novel_name, novel_text)
+    novel_tasks = novel_sents_to_tasks(novel_name, novel_text, context_width)
     return novel_tasks
 
 
-def create_novel_events_predictions(novel_tasks, novel_name):
+def create_novel_events_predictions(novel_tasks, novel_name, index=None):
     """Pre-annotates the mentions in the label-studio tasks for a novel
 
     novel_tasks: tasks in label-studio json format
     novel_name: str -- used to find mentions file
+    index: Index | None -- index of the novel, read from the .tok file if None
 
     return -> tasks in label-studio json format -- now with pre-annotations
     """
     fname = f'./openboek-main/entities/{novel_name}.mentions.tsv'
     mentions = pd.read_csv(fname, sep='\t', index_col=0, quoting=3)
-    index = Index(f'./openboek-main/tokenized/{novel_name}.tok')
-
-    # add all entities to the 'predictions' of the sentence"""
+    if index is None:
+        index = Index(f'./openboek-main/tokenized/{novel_name}.tok')
+
+    # get character indices relative to the sentences, for all mentions at once
+    sentnos = mentions['sentno'].to_numpy(dtype=np.int64)
+    sent_start_idxs, _ = index.gsenttoks2charidx(
+        sentnos, np.zeros_like(sentnos))
+    start_idxs, _ = index.gsenttoks2charidx(
+        sentnos, mentions['begin'].to_numpy(dtype=np.int64))
+    _, end_idxs = index.gsenttoks2charidx(
+        sentnos, mentions['end'].to_numpy(dtype=np.int64) - 1)
+    mention_ids = (novel_tasks[0]['data']['title'] + '_mention_id_'
+                   + mentions.index.astype(str))
+
+    # add all entities to the 'predictions' of the sentence
     # use extracted mentions to add entity spans (predictions) to final json
-    for mention_idx, mention in mentions.to_dict('index').items():
-        # get character index relative to this sentence
-        sent_start_idx = index.gsenttok2charidx[mention['sentno'], 0][0]
-        start_idx = (index.gsenttok2charidx[
-            mention['sentno'], mention['begin']][0] - sent_start_idx)
-        end_idx = (index.gsenttok2charidx[
-            mention['sentno'], mention['end'] - 1][1] - sent_start_idx)
+    for sentno, start_idx, end_idx, text, mention_id in zip(
+            sentnos.tolist(), (start_idxs - sent_start_idxs).tolist(),
+            (end_idxs - sent_start_idxs).tolist(), mentions['text'].tolist(),
+            mention_ids.tolist()):
         result_item = {
             'value': {
                 'start': start_idx,
                 'end': end_idx,
-                'text': mention['text'],
+                'text': text,
                 'labels': ['mention'],
             },
-            'id': (novel_tasks[0]['data']['title']
-                   + '_mention_id_' + str(mention_idx)),
+            'id': mention_id,
             'from_name': 'entities',
             'to_name': 'text',
             'type': 'labels',
@@ -165,16 +205,63 @@ def create_novel_events_predictions(novel_tasks, novel_name):
         }
 
         # append item to index in json that corresponds with 'sentno' field
-        novel_tasks[mention['sentno']]['predictions'][0]['result'].append(
-            result_item)
+        novel_tasks[sentno]['predictions'][0]['result'].append(result_item)
 
         # set id field
-        novel_tasks[mention['sentno']]['predictions'][0]['id'] = \
-            f'{novel_name}_{mention["sentno"]}'
+        novel_tasks[sentno]['predictions'][0]['id'] = f'{novel_name}_{sentno}'
 
     return novel_tasks
 
 
+def pre_annotate_novel(novel_name, context_width=CONTEXT_WIDTH):
+    """Creates the pre-annotated tasks for one novel, reading its .tok file
+    once for both the tasks and the index
+
+    novel_name: str
+    context_width: int -- amount of sentences of context before and after
+
+    return -> tasks in label-studio json format
+    """
+    fname = f'./openboek-main/tokenized/{novel_name}.tok'
+    with open(fname, 'r', encoding='utf-8') as inp:
+        novel_text = inp.readlines()
+
+    novel_tasks = novel_sents_to_tasks(novel_name, novel_text, context_width)
+    index = Index(fname, novel_text)
+    return create_novel_events_predictions(novel_tasks, novel_name, index)
+
+
+def iter_pre_annotated_novels(novels, processes=0,
+                              context_width=CONTEXT_WIDTH):
+    """Yields the pre-annotated tasks of every novel, in the order of novels.
+    Novels are independent, so with processes they are pre-annotated in
+    parallel by a pool of that many processes. At most twice as many novels
+    as processes are handed out at a time, so the finished novels that are
+    not written yet do not pile up in memory.
+
+    novels: list[str]
+    processes: int -- 0 to pre-annotate in this process
+    context_width: int -- amount of sentences of context before and after
+
+    return -> iterator of a list of tasks per novel
+    """
+    pre_annotate = partial(pre_annotate_novel, context_width=context_width)
+    if not processes:
+        yield from map(pre_annotate, novels)
+        return
+
+    with Pool(processes) as pool:
+        # the results are yielded in the order of the novels, so the random
+        # ids are the same
+        pending = deque()
+        for novel_name in novels:
+            if len(pending) == 2 * processes:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(pre_annotate, (novel_name,)))
+        while pending:
+            yield pending.popleft().get()
+
+
 def add_random_ids(all_tasks):
     """Add unique random id fields to be able to randomize annotating"""
 
@@ -213,7 +300,88 @@ def create_annotations_with_prediction_id(all_tasks, task_amount):
     return all_tasks
 
 
-def create_events_tasks():
+def get_novel_names():
+    """Returns the names of all novels in the corpus, sorted so the random ids
+    do not depend on the order of the files on disk"""
+    return sorted(
+        file[:-4] for file in os.listdir('./openboek-main/original'))
+
+
+def count_novel_sents(novel_name):
+    """Counts the sentences (lines) of a novel, which is its amount of tasks"""
+    with open(f'./openboek-main/tokenized/{novel_name}.tok',
+              'r', encoding='utf-8') as inp:
+        return sum(1 for _ in inp)
+
+
+def shuffled_ids(task_amount, seed=None):
+    """Returns the random ids for task_amount tasks: a shuffled range, stored
+    as an array of integers instead of a list of int objects
+
+    task_amount: int
+    seed: int | None -- seed for the shuffle, random if None
+
+    return -> array of int
+    """
+    random_ids = array('l', range(task_amount))
+    random.Random(seed).shuffle(random_ids)
+    return random_ids
+
+
+def iter_events_tasks(novels, seed=None, processes=0,
+                      context_width=CONTEXT_WIDTH):
+    """Yields the pre-annotated tasks of the novels, one novel at a time, with
+    random ids assigned from a shuffled range over all tasks.
+
+    novels: list[str]
+    seed: int | None -- seed for the random ids
+    processes: int -- amount of processes pre-annotating novels in parallel
+    context_width: int -- amount of sentences of context before and after
+
+    return -> iterator of tasks in label studio json format
+    """
+    random_ids = shuffled_ids(
+        sum(count_novel_sents(novel) for novel in novels), seed)
+
+    task_no = 0
+    for novel_tasks in iter_pre_annotated_novels(novels, processes,
+                                                 context_width):
+        for task in novel_tasks:
+            task['data']['randomid'] = random_ids[task_no]
+            task_no += 1
+            yield task
+
+
+def write_tasks(tasks, outp, compact=False):
+    """Writes the tasks to outp as a json list, one task at a time. The output
+    is the same as json.dump(tasks, outp, indent=4), unless compact is set;
+    then every task is written on one line without spaces.
+
+    tasks: iterable of tasks in label studio json format
+    outp: text file
+
+    return -> the amount of written tasks
+    """
+    if compact:
+        separator, start, end = ',\n', '[\n', '\n]'
+    else:
+        separator, start, end = ',\n    ', '[\n    ', '\n]'
+
+    task_amount = 0
+    for task in tasks:
+        outp.write(separator if task_amount else start)
+        if compact:
+            outp.write(json.dumps(task, separators=(',', ':')))
+        else:
+            # indent the task once more, as it is an item of the list
+            outp.write(json.dumps(task, indent=4).replace('\n', '\n    '))
+        task_amount += 1
+
+    outp.write(end if task_amount else '[]')
+    return task_amount
+
+
+def create_events_tasks(seed=None, processes=0):
     """Creates the json format pre-annotated tasks for events annotation
 
     Do not change this function name, this function gets called by setup.py
@@ -225,20 +393,48 @@ def create_events_tasks():
               file=sys.stderr)
         return []
 
-    # get novel names to add to tasks
-    novels = [file[:-4] for file in os.listdir('./openboek-main/original')]
-
-    all_tasks = []
-
-    for novel in novels:
-        novel_tasks = create_novel_events_tasks(novel)
-        novel_tasks = create_novel_events_predictions(novel_tasks, novel)
-        all_tasks = all_tasks + novel_tasks
-
     # all_tasks = create_annotations_with_prediction_id(all_tasks, 3)
-    all_tasks = add_random_ids(all_tasks)
+    return list(iter_events_tasks(get_novel_names(), seed, processes))
+
+
+def parse_args(argv):
+    """Creates an argument parser for the program"""
+    parser = argparse.ArgumentParser(
+        prog='Events tasks program',
+        description='Creates pre-annotated event tasks for Label Studio',
+    )
+
+    parser.add_argument('output', help='.json file to write the tasks to')
+    parser.add_argument(
+        'novel', nargs='?',
+        help='any file of a novel in openboek-main, to only create its tasks')
+
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='write every task on one line, without indentation')
+    parser.add_argument(
+        '--processes', type=int, default=0,
+        help='pre-annotate novels in parallel in this many processes '
+        '(default: 0, pre-annotate in the main process)')
+    parser.add_argument(
+        '--context-width', type=int, default=CONTEXT_WIDTH,
+        help='amount of sentences before and after every sentence to add as '
+        f'context (default: {CONTEXT_WIDTH})')
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help='seed for the random ids, to create the same ids every run')
+
+    args = parser.parse_args(argv[1:])
 
-    return all_tasks
+    # prevent overwriting source files when messing up command line args
+    if not args.output.endswith('.json'):
+        parser.error('Output file is not a .json file')
+    if args.processes < 0:
+        parser.error('--processes cannot be negative')
+    if args.context_width < 0:
+        parser.error('--context-width cannot be negative')
+
+    return args
 
 
 def main(argv):
@@ -251,33 +447,32 @@ def main(argv):
     openboek-main folder. For exaple:
 
     python3 events.py [../output.json] [../openboek/original/novel.txt]
-    """
 
-    # check for correct amount of command-line arguments
-    if len(argv) < 2:
-        print('Provide an output filename', file=sys.stderr)
-        sys.exit(1)
+    Add --compact to write every task on one line, without indentation.
+    Add --processes 8 to pre-annotate 8 novels at a time, and --seed 123 to
+    get the same random ids every time.
+    Add --context-width 4 to add 4 sentences of context on both sides.
+    """
 
-    # prevent overwriting source files when messing up command line args
-    if not argv[1].endswith('.json'):
-        print('Output file is not a .json file', file=sys.stderr)
-        sys.exit(1)
+    args = parse_args(argv)
 
     # if novel is specified, only make tasks for that novel
-    if len(argv) == 3:
+    if args.novel is not None:
         # do not use this function on a Windows system!
-        novel_name = os.path.basename(argv[2]).split('.')[0]
-
-        tasks = create_novel_events_tasks(novel_name)
-        tasks = create_novel_events_predictions(tasks, novel_name)
-        tasks = add_random_ids(tasks)
+        novels = [os.path.basename(args.novel).split('.')[0]]
     # otherwise make tasks for all novels
+    elif os.path.exists('./openboek-main/'):
+        novels = get_novel_names()
     else:
-        tasks = create_events_tasks()
+        print('Cannot create tasks because ./openboek-main cannot be found',
+              file=sys.stderr)
+        novels = []
 
-    # write tasks as json to the output file
-    with open(argv[1], 'w', encoding='utf=8') as outp:
-        json.dump(tasks, outp, indent=4)
+    # write the tasks as json to the output file while they are created
+    with open(args.output, 'w', encoding='utf=8') as outp:
+        tasks = iter_events_tasks(
+            novels, args.seed, args.processes, args.context_width)
+        write_tasks(tasks, outp, args.compact)
 
 
 if __name__ == '__main__':
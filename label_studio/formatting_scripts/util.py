@@ -1,3 +1,9 @@
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+
 def convert(line):
     """
     >>> convert('12-34|Hallo , wereld !')
@@ -8,9 +14,91 @@ def convert(line):
     return ((int(sentno), int(parno)), sent)
 
 
+# the root util.py has the same parser, which the Label Studio environment
+# cannot import
+def iter_tasks(file, chunk_size=1 << 16):
+    """Yields the tasks of a Label Studio json file (an export or an import)
+    one at a time, parsing the top-level array in chunks instead of loading
+    the whole file
+
+    file: text file
+    chunk_size: int -- amount of characters to read at a time
+
+    return -> iterator of tasks in label studio json format
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError(
+            'The Label Studio file should be a json array of tasks')
+
+    position = 1
+    end_of_file = False
+    while True:
+        # skip the separators between tasks
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        if position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            task, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if end_of_file:
+                raise
+
+            # the task is not complete yet, so read (more and more) of the file
+            chunk = file.read(max(chunk_size, len(buffer) - position))
+            end_of_file = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield task
+
+
+class IndexView(Mapping):
+    """Read-only mapping that computes its values from the arrays of an Index
+    when they are looked up, instead of storing a tuple for every key.
+
+    :ivar lookup: function from a key to its value, raises KeyError
+    :ivar iterkeys: function returning an iterator over all keys
+    :ivar length: the amount of keys
+    """
+    def __init__(self, lookup, iterkeys, length):
+        self.lookup = lookup
+        self.iterkeys = iterkeys
+        self.length = length
+
+    def __getitem__(self, key):
+        try:
+            return self.lookup(key)
+        except (TypeError, ValueError, IndexError):
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return self.length
+
+
 class Index:
     """Map various indices to other types of indices.
 
+    The character offsets of the tokens are stored in arrays in the order of
+    the novel, together with the global token index of the first token of
+    every sentence, so every lookup is a bit of arithmetic.
+
+    :ivar tokstarts: start character index of every token in the novel
+    :ivar tokends: end character index of every token in the novel
+    :ivar sentoffsets: the tokens of global sentence number i are
+        tokstarts[sentoffsets[i]:sentoffsets[i + 1]]
+    :ivar parsents: (parno, sentno) of every global sentence number
+
+    The following mappings are views of these arrays:
+
     :ivar parsenttok2charidx: maps (parno, sentno, tokenno)
         to (startcharidx, endcharidx).
         (parno, sentno) is a paragraph number and sentence number within
@@ -22,25 +110,104 @@ class Index:
     :ivar parsent2gsent: maps (parno, sentno) to global sentence number
     :ivar gsent2sentpar: maps global sentence number to (parno, sentno)
     """
-    def __init__(self, fname):
-        with open(fname, 'r', encoding='utf8') as inp:
-            sents = [convert(line) for line in inp.read().splitlines()]
-        self.gsenttok2charidx = {}
-        self.parsenttok2charidx = {}
-        self.gtok2charidx = {}
-        self.parsent2gsent = {}
-        self.gsent2sentpar = {}
-        charidx = 0
-        gtokidx = 0
-        for gsentno, ((parno, sentno), sent) in enumerate(sents):
-            tokidx = 0
-            self.parsent2gsent[parno, sentno] = gsentno
-            self.gsent2sentpar[gsentno] = parno, sentno
-            for n, token in enumerate(sent.split(' ')):
-                cur = (charidx, charidx + len(token))
-                self.gsenttok2charidx[gsentno, tokidx] = cur
-                self.parsenttok2charidx[parno, sentno, tokidx] = cur
-                self.gtok2charidx[gtokidx] = cur
-                tokidx += 1
-                gtokidx += 1
-                charidx += len(token) + 1  # token + space/newline
+    def __init__(self, fname, lines=None):
+        """Indexes the .tok file fname, or its lines if already read"""
+        if lines is None:
+            with open(fname, 'r', encoding='utf8') as inp:
+                lines = inp.read().splitlines()
+        else:
+            lines = ''.join(lines).splitlines()
+        sents = [convert(line) for line in lines]
+
+        # tokens end at a space or newline, character indices count code points
+        text = ''.join(sent + '\n' for _, sent in sents)
+        codepoints = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        self.tokends = np.flatnonzero(
+            (codepoints == ord(' ')) | (codepoints == ord('\n')))
+        self.tokstarts = np.concatenate([[0], self.tokends + 1])[:-1]
+
+        self.sentoffsets = np.zeros(len(sents) + 1, dtype=np.int64)
+        np.cumsum([sent.count(' ') + 1 for _, sent in sents],
+                  out=self.sentoffsets[1:])
+        self.parsents = np.array(
+            [parsent for parsent, _ in sents], dtype=np.int64).reshape(-1, 2)
+
+        # one entry per sentence, a later duplicate (parno, sentno) wins
+        self.parsent2gsent = {
+            parsent: gsentno for gsentno, (parsent, _) in enumerate(sents)}
+
+        self.gsenttok2charidx = IndexView(
+            lambda key: self.span(self.gsenttok2gtok(*key)),
+            self._iter_gsenttoks, len(self.tokstarts))
+        self.parsenttok2charidx = IndexView(
+            lambda key: self.span(self.parsenttok2gtok(*key)),
+            self._iter_parsenttoks,
+            sum(self.sentlen(gsentno)
+                for gsentno in self.parsent2gsent.values()))
+        self.gtok2charidx = IndexView(
+            lambda gtokidx: self.span(self.check_gtok(gtokidx)),
+            lambda: iter(range(len(self.tokstarts))), len(self.tokstarts))
+        self.gsent2sentpar = IndexView(
+            lambda gsentno: tuple(
+                int(no) for no in self.parsents[self.check_gsent(gsentno)]),
+            lambda: iter(range(len(self.parsents))), len(self.parsents))
+
+    def sentlen(self, gsentno):
+        """Returns the amount of tokens in a global sentence"""
+        return int(self.sentoffsets[gsentno + 1] - self.sentoffsets[gsentno])
+
+    def check_gsent(self, gsentno):
+        """Returns gsentno if it is a global sentence number"""
+        if not 0 <= gsentno < len(self.parsents):
+            raise KeyError(gsentno)
+        return gsentno
+
+    def check_gtok(self, gtokidx):
+        """Returns gtokidx if it is a global token index"""
+        if not 0 <= gtokidx < len(self.tokstarts):
+            raise KeyError(gtokidx)
+        return gtokidx
+
+    def gsenttok2gtok(self, gsentno, tokidx):
+        """Returns the global token index of a token in a global sentence"""
+        if not 0 <= tokidx < self.sentlen(self.check_gsent(gsentno)):
+            raise KeyError((gsentno, tokidx))
+        return int(self.sentoffsets[gsentno]) + tokidx
+
+    def parsenttok2gtok(self, parno, sentno, tokidx):
+        """Returns the global token index of a token in a paragraph sentence"""
+        return self.gsenttok2gtok(self.parsent2gsent[parno, sentno], tokidx)
+
+    def span(self, gtokidx):
+        """Returns the (startcharidx, endcharidx) of a global token index"""
+        return int(self.tokstarts[gtokidx]), int(self.tokends[gtokidx])
+
+    def gsenttoks2charidx(self, gsentnos, tokidxs):
+        """Returns the start and end character indices of many tokens at once.
+
+        gsentnos: array of int -- global sentence numbers
+        tokidxs: array of int -- token numbers within these sentences
+
+        return -> (array of startcharidx, array of endcharidx)
+        """
+        gsentnos = np.asarray(gsentnos)
+        tokidxs = np.asarray(tokidxs)
+        sentlens = np.diff(self.sentoffsets)
+        if np.any((gsentnos < 0) | (gsentnos >= len(sentlens))) or np.any(
+                (tokidxs < 0) | (tokidxs >= sentlens[gsentnos])):
+            raise KeyError('token outside of the sentences of the novel')
+
+        gtokidxs = self.sentoffsets[gsentnos] + tokidxs
+        return self.tokstarts[gtokidxs], self.tokends[gtokidxs]
+
+    def _iter_gsenttoks(self):
+        """Yields every (gsentno, tokenno) in the order of the novel"""
+        for gsentno in range(len(self.parsents)):
+            for tokidx in range(self.sentlen(gsentno)):
+                yield gsentno, tokidx
+
+    def _iter_parsenttoks(self):
+        """Yields every (parno, sentno, tokenno) in the order of the novel"""
+        for (parno, sentno), gsentno in self.parsent2gsent.items():
+            for tokidx in range(self.sentlen(gsentno)):
+                yield parno, sentno, tokidx
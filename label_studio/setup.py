@@ -1,70 +1,375 @@
 """Script to set up Label Studio with our projects"""
 import sys
 import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
 from label_studio_sdk import Client
 from config import API_KEY
+from formatting_scripts.util import iter_tasks
 
 # sets the URL to the url set in run.sh
 # defaults to localhost if environment variables are not set
 LABEL_STUDIO_URL = os.getenv('LABEL_STUDIO_HOST', 'http://localhost') + \
     ':' + os.getenv('LABEL_STUDIO_PORT', '8787')
 
+TASKS_FILEPATH = './pre-annotations.json'
+# keeps track of the imported chunks, so a failed import can be resumed
+LEDGER_FILEPATH = TASKS_FILEPATH + '.ledger.json'
+BATCH_SIZE = 500  # tasks per import request
+UPLOAD_WORKERS = 4  # import requests in flight at the same time
+MAX_RETRIES = 5  # retries of an unsent chunk before the import is stopped
+BACKOFF = 1.0  # seconds before the first retry, doubled every retry
+TIMEOUT = 300  # seconds to wait for Label Studio to accept a chunk
 
-def create_project(ls_client, project_name):
-    """Creates an annotation project
 
-    Also sets the interface, creates tasks if not present, and imports the tasks
-    """
+def parse_args(argv):
+    """Creates an argument parser for the program"""
+    parser = argparse.ArgumentParser(
+        prog='Label Studio setup program',
+        description='Creates the annotation projects and imports the tasks',
+    )
+
+    parser.add_argument(
+        '--batch-size', type=int, default=BATCH_SIZE,
+        help=f'tasks per import request (default: {BATCH_SIZE})')
+    parser.add_argument(
+        '--workers', type=int, default=UPLOAD_WORKERS,
+        help='import requests in flight at a time '
+        f'(default: {UPLOAD_WORKERS})')
+    parser.add_argument(
+        '--retries', type=int, default=MAX_RETRIES,
+        help='retries of a chunk that could not be sent, or was refused '
+        f'because of too many requests (default: {MAX_RETRIES})')
+    parser.add_argument(
+        '--resend-uncertain', action='store_true',
+        help='send the chunks again that may or may not have been imported '
+        'before, only use this after checking they are not in the project')
+
+    args = parser.parse_args(argv[1:])
+
+    if args.batch_size < 1 or args.workers < 1 or args.retries < 0:
+        parser.error('--batch-size and --workers should be at least 1, and '
+                     '--retries cannot be negative')
+
+    return args
+
+
+def iter_chunks(filepath, batch_size):
+    """Yields the chunk number and the tasks of every chunk of batch_size
+    tasks in the file"""
+    chunk = []
+    chunk_no = 0
+    with open(filepath, 'r', encoding='utf-8') as inp:
+        for task in iter_tasks(inp):
+            chunk.append(task)
+            if len(chunk) == batch_size:
+                yield chunk_no, chunk
+                chunk = []
+                chunk_no += 1
+    if chunk:
+        yield chunk_no, chunk
 
-    print(f'Creating {project_name} project')
 
-    # open the interface file
+def load_ledger(ledger_filepath, tasks_filepath, batch_size):
+    """Loads the ledger of an earlier import of the tasks file. A new ledger
+    is returned if there is none, or if the tasks file or batch size changed,
+    because then the chunks do not contain the same tasks anymore.
+
+    return -> dict with the project id, the accepted chunk numbers, and the
+        chunk numbers that may or may not have been imported
+    """
+    stat = os.stat(tasks_filepath)
+    ledger = {
+        'tasks_file': tasks_filepath,
+        'fingerprint': [stat.st_size, stat.st_mtime_ns],
+        'batch_size': batch_size,
+        'project_id': None,
+        'accepted': [],
+        'uncertain': [],
+    }
+
     try:
-        with open('./interface.xml', 'r', encoding='utf-8') as inp:
-            interface = inp.read()
-    except FileNotFoundError as err:
-        print(
-            f'There is no interace file for \'{project_name}\', so the project'
-            f'was not created:\n{err}\n', file=sys.stderr
-        )
+        with open(ledger_filepath, 'r', encoding='utf-8') as inp:
+            old_ledger = json.load(inp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return ledger
+
+    if all(old_ledger.get(key) == ledger[key]
+           for key in ['tasks_file', 'fingerprint', 'batch_size']):
+        return old_ledger
+
+    print(f'{tasks_filepath} or the batch size changed since the last import, '
+          f'so it is imported into a new project', file=sys.stderr)
+    return ledger
+
+
+def save_ledger(ledger, ledger_filepath):
+    """Writes the ledger, replacing the old ledger at once"""
+    with open(ledger_filepath + '.tmp', 'w', encoding='utf-8') as outp:
+        json.dump(ledger, outp)
+    os.replace(ledger_filepath + '.tmp', ledger_filepath)
+
+
+def create_session(api_key, pool_size):
+    """Creates an HTTP session that keeps pool_size connections open, so the
+    chunks are not all uploaded over new connections"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Authorization'] = f'Token {api_key}'
+    return session
+
+
+class UncertainImportError(requests.exceptions.RequestException):
+    """A chunk was sent, but it is unknown whether Label Studio imported it,
+    so sending it again could import its tasks twice"""
+
+
+def is_connect_error(err):
+    """Returns whether a connection error happened while connecting, so the
+    request was never sent"""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], 'reason', None) if err.args else None
+    # NewConnectionError (e.g. connection refused) is a ConnectTimeoutError
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def upload_chunk(session, import_url, tasks, retries=MAX_RETRIES,
+                 backoff=BACKOFF):
+    """Posts a chunk of tasks to the import url.
+
+    An import is not idempotent, so only errors that mean the chunk was not
+    imported are retried with an exponential backoff: failing to connect and
+    429 Too Many Requests. A time-out while waiting for the response, a lost
+    connection or a server error raise UncertainImportError, and other errors
+    (like invalid tasks) are raised immediately.
+
+    return -> the response of Label Studio
+    """
+    for attempt in range(retries + 1):
+        try:
+            response = session.post(import_url, json=tasks, timeout=TIMEOUT)
+        except requests.exceptions.ConnectionError as err:
+            if not is_connect_error(err):
+                raise UncertainImportError(
+                    f'Lost the connection after sending to {import_url}: '
+                    f'{err}') from err
+            error = err
+        except requests.exceptions.Timeout as err:
+            raise UncertainImportError(
+                f'No response in time from {import_url}: {err}') from err
+        else:
+            if response.status_code >= 500:
+                raise UncertainImportError(
+                    f'{response.status_code} Server Error: {response.reason} '
+                    f'for url: {import_url}', response=response)
+            if response.status_code != 429:
+                response.raise_for_status()
+                return response
+            error = requests.exceptions.HTTPError(
+                f'429 Too Many Requests for url: {import_url}',
+                response=response)
+
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+
+    raise error
+
+
+def import_tasks(url, api_key, project_id, tasks_filepath, ledger,
+                 ledger_filepath=LEDGER_FILEPATH, batch_size=BATCH_SIZE,
+                 workers=UPLOAD_WORKERS, retries=MAX_RETRIES, backoff=BACKOFF,
+                 resend_uncertain=False):
+    """Imports the tasks file into a project in chunks of batch_size tasks,
+    with workers chunks uploading at the same time. Every finished chunk is
+    added to the ledger, as accepted or as uncertain. Accepted chunks are
+    skipped, and so are uncertain chunks unless resend_uncertain is set.
+
+    url: str -- url of the Label Studio server
+    project_id: int -- id of the project to import the tasks into
+    ledger: dict -- loaded with load_ledger
+
+    return -> the amount of imported tasks
+    """
+    import_url = f'{url}/api/projects/{project_id}/import'
+    accepted = set(ledger['accepted'])
+    uncertain = set(ledger.get('uncertain', []))
+    pending = {}
+    task_amount = 0
+
+    def finish(futures, raise_errors=True):
+        """Adds the finished chunks to the ledger, and raises the error of a
+        failed chunk"""
+        nonlocal task_amount
+        errors = []
+        for future in futures:
+            chunk_no, chunk_size = pending.pop(future)
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if error is None:
+                accepted.add(chunk_no)
+                uncertain.discard(chunk_no)
+                task_amount += chunk_size
+            else:
+                if isinstance(error, UncertainImportError):
+                    uncertain.add(chunk_no)
+                errors.append(error)
+
+        ledger['accepted'] = sorted(accepted)
+        ledger['uncertain'] = sorted(uncertain)
+        save_ledger(ledger, ledger_filepath)
+        if errors and raise_errors:
+            raise errors[0]
+
+    with create_session(api_key, workers) as session, \
+            ThreadPoolExecutor(workers) as executor:
+        try:
+            for chunk_no, chunk in iter_chunks(tasks_filepath, batch_size):
+                if chunk_no in accepted or (
+                        chunk_no in uncertain and not resend_uncertain):
+                    continue
+
+                # only keep the chunks that are in flight in memory
+                if len(pending) >= workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    finish(done)
+
+                future = executor.submit(
+                    upload_chunk, session, import_url, chunk, retries, backoff)
+                pending[future] = chunk_no, len(chunk)
+
+            finish(wait(pending).done)
+        except BaseException:
+            # record the chunks that finished before stopping
+            for future in pending:
+                future.cancel()
+            finish(wait(pending).done, raise_errors=False)
+            raise
+
+    return task_amount
+
+
+def print_uncertain_chunks(ledger, batch_size):
+    """Tells which tasks may or may not have been imported, and how to resend
+    them once it is checked they are not in the project"""
+    if not ledger['uncertain']:
         return
 
-    # create the project and set the interface
+    print(
+        f'It is unknown whether these chunks were imported into project '
+        f'{ledger["project_id"]}, so they were not sent again:',
+        file=sys.stderr
+    )
+    for chunk_no in ledger['uncertain']:
+        first_task = chunk_no * batch_size
+        print(f'tasks {first_task}-{first_task + batch_size - 1} of '
+              f'{ledger["tasks_file"]}', file=sys.stderr)
+    print('Check if these tasks are in the project, and if they are not, run '
+          'this script again with --resend-uncertain\n', file=sys.stderr)
+
+
+def create_project(ls_client, project_name, batch_size=BATCH_SIZE,
+                   workers=UPLOAD_WORKERS, retries=MAX_RETRIES,
+                   resend_uncertain=False):
+    """Creates an annotation project
+
+    Also sets the interface, and imports the tasks in chunks. If an earlier
+    import did not finish, its project is used and only the chunks that were
+    not imported yet are imported.
+    """
+
     try:
-        project = ls_client.start_project(
-            title=project_name,
-            description=f'Openboek annotation task for {project_name}',
-            label_config=interface
-        )
-    except requests.exceptions.HTTPError as err:
+        ledger = load_ledger(LEDGER_FILEPATH, TASKS_FILEPATH, batch_size)
+    except FileNotFoundError as err:
         print(
-            f'The interface for \'{project_name}\' is not valid, so the project '
-            f'was not created:\n{err}\n', file=sys.stderr
+            f'There are no annotation tasks for \'{project_name}\', so the '
+            f'project was not created:\n{err}\n', file=sys.stderr
         )
         return
 
-    # import the annotation tasks
+    if ledger['project_id'] is not None:
+        print(f'Resuming the import of the {project_name} project, '
+              f'{len(ledger["accepted"])} chunks of {batch_size} tasks were '
+              f'imported before')
+
+    else:
+        print(f'Creating {project_name} project')
+
+        # open the interface file
+        try:
+            with open('./interface.xml', 'r', encoding='utf-8') as inp:
+                interface = inp.read()
+        except FileNotFoundError as err:
+            print(
+                f'There is no interace file for \'{project_name}\', so the '
+                f'project was not created:\n{err}\n', file=sys.stderr
+            )
+            return
+
+        # create the project and set the interface
+        try:
+            project = ls_client.start_project(
+                title=project_name,
+                description=f'Openboek annotation task for {project_name}',
+                label_config=interface
+            )
+        except requests.exceptions.HTTPError as err:
+            print(
+                f'The interface for \'{project_name}\' is not valid, so the '
+                f'project was not created:\n{err}\n', file=sys.stderr
+            )
+            return
+
+        ledger['project_id'] = project.id
+        save_ledger(ledger, LEDGER_FILEPATH)
+
+    # import the annotation tasks in chunks
     try:
-        project.import_tasks('./pre-annotations.json')
-    except requests.exceptions.HTTPError as err:
+        task_amount = import_tasks(
+            LABEL_STUDIO_URL, API_KEY, ledger['project_id'], TASKS_FILEPATH,
+            ledger, batch_size=batch_size, workers=workers, retries=retries,
+            resend_uncertain=resend_uncertain)
+    except (requests.exceptions.RequestException, ValueError) as err:
         print(
             f'Something went wrong trying to import the annotation tasks for '
             f'\'{project_name}\':\n{err}\nTry checking the contents of the '
-            f'./pre_annotations/{project_name}.json file.\n', file=sys.stderr
+            f'{TASKS_FILEPATH} file. Run this script again to import the '
+            f'remaining tasks.\n', file=sys.stderr
         )
+        print_uncertain_chunks(ledger, batch_size)
         return
 
+    if ledger['uncertain']:
+        print_uncertain_chunks(ledger, batch_size)
+        return
+
+    # the import is complete, so running this again creates a new project
+    os.remove(LEDGER_FILEPATH)
+
+    print(f'Imported {task_amount} tasks')
     print(f'Successfully created the {project_name} project!\n')
 
     return
 
 
-def main():
+def main(argv):
     """Links Label Studio SDK and creates different projects
 
     Has to be run if label-studio server is running.
+    Add --batch-size 1000 --workers 8 --retries 3 to change how the tasks are
+    imported, and --resend-uncertain to send chunks again that may or may not
+    have been imported before.
     """
+    args = parse_args(argv)
+
     # initialize Label Studio Client
     try:
         ls_client = Client(url=LABEL_STUDIO_URL, api_key=API_KEY)
@@ -80,10 +385,11 @@ def main():
         print(f'Could not connect to Label Studio, is it running?\n{err}')
         sys.exit(1)
 
-    create_project(ls_client, 'events')
+    create_project(ls_client, 'events', args.batch_size, args.workers,
+                   args.retries, args.resend_uncertain)
 
     print(f'The created projects are now visible at {LABEL_STUDIO_URL}')
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv)
@@ -1,43 +1,280 @@
 """Script to merge separate Label Studio annotation file into one"""
+import os
 import sys
 import json
+import argparse
+from typing import BinaryIO
 import more_itertools as mit
+from util import iter_tasks
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    """Creates an argument parser for the program"""
+    parser = argparse.ArgumentParser(
+        prog='Merge annotations program',
+        description='Merges Label Studio annotation exports into one file',
+    )
+
+    parser.add_argument(
+        'filepaths',
+        help='Label Studio .json exports to merge, followed by the merged file',
+        nargs='+',
+    )
+
+    # allow adding new batches to an earlier merged file
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='only append tasks that are not in the merged file yet, using the '
+        'index of randomids next to it',
+    )
+
+    # allow choosing which annotation of a duplicate randomid is kept
+    parser.add_argument(
+        '--on-duplicate',
+        choices=['first', 'latest', 'fail'],
+        default='first',
+        help='keep the first annotation of a duplicate randomid, the one with '
+        'the highest lead_time, or stop without merging (default: first)',
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    if len(args.filepaths) < 2:
+        parser.error('Provide at least one file to merge and an output file')
+
+    return args
+
+
+def load_index(filepath: str, merged_filepath: str) -> dict[int, float]:
+    """Loads the randomids and lead times of the tasks in the merged file.
+    If there is no index (e.g. the file was merged before indexes existed, or
+    a merge was interrupted while the tasks were replaced), it is rebuilt from
+    the merged file itself.
+    """
+
+    try:
+        with open(filepath, 'r', encoding='UTF-8') as inp:
+            return {int(randomid): lead_time for randomid, lead_time in json.load(inp)}
+    except FileNotFoundError:
+        if not os.path.exists(merged_filepath):
+            return {}
+
+    print(f'No index found, rebuilding it from {merged_filepath}')
+    with open(merged_filepath, 'r', encoding='UTF-8') as inp:
+        return dict(task_key(task) for task in iter_tasks(inp))
+
+
+def save_index(index: dict[int, float], filepath: str) -> None:
+    """Writes the randomids and lead times of the tasks in the merged file"""
+
+    with open(filepath + '.tmp', 'w', encoding='UTF-8') as outp:
+        json.dump(sorted(index.items()), outp)
+    os.replace(filepath + '.tmp', filepath)
+
+
+def save_length(length: int, length_filepath: str) -> None:
+    """Writes the length in bytes of the merged file without its closing
+    bracket before tasks are appended to it, 0 if it does not exist yet
+    """
+
+    with open(length_filepath + '.tmp', 'w', encoding='UTF-8') as outp:
+        json.dump(length, outp)
+    os.replace(length_filepath + '.tmp', length_filepath)
+
+
+def restore_length(filepath: str, length_filepath: str) -> None:
+    """Undoes an append to the merged file that was interrupted, by truncating
+    it back to the length saved before the append and closing the array
+    """
+
+    if not os.path.exists(length_filepath):
+        return
+
+    with open(length_filepath, 'r', encoding='UTF-8') as inp:
+        length = json.load(inp)
+
+    print(f'Undoing the interrupted merge into {filepath}')
+    if length == 0:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    else:
+        with open(filepath, 'r+b') as outp:
+            outp.truncate(length)
+            outp.seek(length)
+            outp.write(b']')
+    os.remove(length_filepath)
+
+
+def task_key(task: dict) -> tuple[int, float]:
+    """Returns the randomid and the lead time of the annotation of a task"""
+
+    annotations = task.get('annotations') or [{}]
+    return int(task['data']['randomid']), annotations[0].get('lead_time', 0)
+
+
+def open_merged_file(
+    filepath: str, length_filepath: str | None = None
+) -> tuple[BinaryIO, bool]:
+    """Opens the merged json array to append tasks after its last task.
+    Returns the file and whether it already contains tasks. The length of the
+    array without its closing bracket is saved to length_filepath (if given)
+    before the file is changed, so an interrupted append can be undone.
+    """
+
+    if not os.path.exists(filepath):
+        if length_filepath is not None:
+            save_length(0, length_filepath)
+        outp = open(filepath, 'wb')
+        outp.write(b'[')
+        return outp, False
+
+    # remove the closing bracket of the array, only reading the end of the file
+    outp = open(filepath, 'r+b')
+    position = outp.seek(0, os.SEEK_END)
+    while position > 0:
+        position = max(position - 1024, 0)
+        outp.seek(position)
+        tail = outp.read(1024)
+        if b']' in tail:
+            end = position + tail.rindex(b']')
+            break
+    else:
+        outp.close()
+        raise ValueError(f'{filepath} is not a json array of tasks')
+
+    if length_filepath is not None:
+        save_length(end, length_filepath)
+    outp.seek(end)
+    outp.truncate()
+
+    outp.seek(max(end - 1024, 0))
+    has_tasks = outp.read(end - outp.tell()).rstrip()[-1:] != b'['
+    outp.seek(end)
+
+    return outp, has_tasks
+
+
+def replace_tasks(filepath: str, replacements: dict[int, dict]) -> None:
+    """Replaces tasks in the merged file by randomid, streaming the file"""
+
+    with open(filepath, 'r', encoding='UTF-8') as inp, open(
+        filepath + '.tmp', 'w', encoding='UTF-8'
+    ) as outp:
+        outp.write('[')
+        for task_no, task in enumerate(iter_tasks(inp)):
+            if task_no:
+                outp.write(', ')
+            json.dump(replacements.get(task_key(task)[0], task), outp)
+        outp.write(']')
+
+    os.replace(filepath + '.tmp', filepath)
 
 
 def main(argv: list[str]):
     """Opens annotatoin files, merges them, and writes them to a new file.
     Last argument is the output file:
     python3 merge_annotations.py export1.json export2.json [add more here] merged.json
+    add --incremental to only append new tasks to an existing merged.json
+    add --on-duplicate first|latest|fail to choose how duplicates are handled
     """
 
-    all_annotations = []
+    args = parse_args(argv)
+    input_filepaths, output_filepath = args.filepaths[:-1], args.filepaths[-1]
+    index_filepath = output_filepath + '.index.json'
+    length_filepath = output_filepath + '.length.json'
+
+    restore_length(output_filepath, length_filepath)
+    index = load_index(index_filepath, output_filepath) if args.incremental else {}
 
-    # open all the files
-    for filepath in argv[1:-1]:
+    # decide which task is kept for every randomid, without writing anything
+    print('performing checks before merging:')
+    winners = {randomid: (lead_time, None) for randomid, lead_time in index.items()}
+    duplicates = []
+    for file_no, filepath in enumerate(input_filepaths):
         with open(filepath, 'r', encoding='UTF-8') as inp:
-            annotations = json.load(inp)
-            all_annotations += annotations
-            print(f'{filepath} has {len(annotations)} annotations.')
-
-    print('\nperforming checks before merging:')
-    # check for double annotations
-    randomids = set()
-    double_found = False
-    for annotation in all_annotations:
-        if int(annotation['data']['randomid']) in randomids:
-            print(f'{annotation["data"]["randomid"]} occurs multiple times.')
-            double_found = True
-        else:
-            randomids.add(int(annotation['data']['randomid']))
-
-    if not double_found:
+            for task_no, task in enumerate(iter_tasks(inp)):
+                randomid, lead_time = task_key(task)
+                if randomid not in winners:
+                    winners[randomid] = (lead_time, (file_no, task_no))
+                    continue
+
+                # a task that is already merged is not a duplicate
+                if randomid in index and index[randomid] == lead_time:
+                    continue
+
+                print(f'{randomid} occurs multiple times.')
+                duplicates.append(randomid)
+                if args.on_duplicate == 'fail':
+                    print('Stopped merging because of duplicates', file=sys.stderr)
+                    sys.exit(1)
+                if args.on_duplicate == 'latest' and lead_time > winners[randomid][0]:
+                    winners[randomid] = (lead_time, (file_no, task_no))
+
+    if not duplicates:
         print('No duplicate annotations have been found')
 
-    # checks for missing annotations
+    # nothing is written before the checks pass. A fresh merge is written to a
+    # temporary file that replaces the output at once. New tasks are appended
+    # to the output in place, after saving its length to undo an interrupted
+    # append, and the old index is kept until the append is done
+    if args.incremental:
+        merge_filepath = output_filepath
+    else:
+        merge_filepath = output_filepath + '.tmp'
+        if os.path.exists(merge_filepath):
+            os.remove(merge_filepath)
+
+    # append the new tasks, and keep the tasks that replace merged tasks
+    replacements = {}
+    outp, has_tasks = open_merged_file(
+        merge_filepath, length_filepath if args.incremental else None
+    )
+    with outp:
+        for file_no, filepath in enumerate(input_filepaths):
+            task_count, new_count = 0, 0
+            with open(filepath, 'r', encoding='UTF-8') as inp:
+                for task_no, task in enumerate(iter_tasks(inp)):
+                    task_count += 1
+                    randomid, lead_time = task_key(task)
+                    if winners[randomid][1] != (file_no, task_no):
+                        continue
+
+                    if randomid in index:
+                        replacements[randomid] = task
+                    else:
+                        if has_tasks:
+                            outp.write(b', ')
+                        outp.write(json.dumps(task).encode('UTF-8'))
+                        has_tasks = True
+                        new_count += 1
+                    index[randomid] = lead_time
+
+            print(f'{filepath} has {task_count} annotations, {new_count} new.')
+        outp.write(b']')
+
+    # the output is about to change, so the old index is removed first (it is
+    # rebuilt from the output if the merge is interrupted from here on)
+    if os.path.exists(index_filepath):
+        os.remove(index_filepath)
+    if args.incremental:
+        os.remove(length_filepath)
+
+    if replacements:
+        replace_tasks(merge_filepath, replacements)
+        print(f'Replaced {len(replacements)} annotations with a higher lead_time')
+
+    if merge_filepath != output_filepath:
+        os.replace(merge_filepath, output_filepath)
+    save_index(index, index_filepath)
+
+    # checks for missing annotations, using the index instead of the merged file
+    randomids = set(index)
     all_randomids = set(range(min(randomids), max(randomids) + 1))
 
     missing_ids = [
-        list(group) for group in mit.consecutive_groups(all_randomids - randomids)
+        list(group)
+        for group in mit.consecutive_groups(sorted(all_randomids - randomids))
     ]
 
     if missing_ids:
@@ -51,11 +288,7 @@ def main(argv: list[str]):
     else:
         print('No missing annotations were found')
 
-    # write combined to output file
-    with open(argv[-1], 'w', encoding='UTF-8') as outp:
-        json.dump(all_annotations, outp)
-
-    print(f"\nSuccessfully wrote all {len(all_annotations)} to '{argv[-1]}'")
+    print(f"\nSuccessfully merged all {len(index)} to '{output_filepath}'")
 
 
 if __name__ == '__main__':
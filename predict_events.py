@@ -1,37 +1,382 @@
 """Uses a fine-tuned BERTje model to predict events in texts"""
+import argparse
 import sys
+import json
 import pickle
 import warnings
 import os
+import time
+from itertools import islice
+from multiprocessing import Pool
+import torch
 from tqdm import tqdm
 from transformers import pipeline
+from event_statistics import invalidate_statistics
+from prediction_store import save_predictions
+from util import iter_predictions
 
 warnings.filterwarnings('ignore')  # ignore the dataset warning
 
 
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    """Creates an argument parser for the program"""
+    parser = argparse.ArgumentParser(
+        prog='Event prediction program',
+        description='Predicts events in DBNL novels with a fine-tuned BERTje model',
+    )
+
+    parser.add_argument('model', help='directory or name of the fine-tuned model')
+    parser.add_argument(
+        'filenames_filepath', help='file containing the filenames of the novels'
+    )
+
+    # allow running sentences through the model in batches of similar length
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help='maximum number of sentences per forward pass (default: 1)',
+    )
+    parser.add_argument(
+        '--max-batch-tokens',
+        type=int,
+        default=None,
+        help='maximum number of (padded) subword tokens per batch',
+    )
+
+    # allow streaming long novels to the predictions file in resumable chunks
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=0,
+        help='stream the novel and write predictions every chunk-size sentences '
+        '(default: 0, keep the whole novel in memory)',
+    )
+
+    # allow writing the predictions as typed columns instead of a pickle
+    parser.add_argument(
+        '--columnar',
+        action='store_true',
+        help='write the predictions to a .predictions directory of typed columns '
+        '(see prediction_store.py) instead of a .predictions.pickle file',
+    )
+
+    # allow sharding the novels over a pool of CPU worker processes
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='number of CPU worker processes, each loading the model once '
+        '(default: 0, predict in this process on the GPU)',
+    )
+    parser.add_argument(
+        '--threads-per-worker',
+        type=int,
+        default=1,
+        help='number of intra-op threads per worker process (default: 1)',
+    )
+
+    args = parser.parse_args(argv[1:])
+
+    if args.batch_size < 1:
+        parser.error('The batch size should be at least 1')
+
+    if args.chunk_size < 0:
+        parser.error('The chunk size cannot be negative')
+
+    if args.workers < 0 or args.threads_per_worker < 1:
+        parser.error(
+            'The number of workers cannot be negative and need at least one thread'
+        )
+
+    return args
+
+
+def batch_by_length(
+    lengths: list[int], batch_size: int, max_batch_tokens: int | None = None
+) -> list[list[int]]:
+    """Groups the indices of sentences with a similar length into batches.
+    A batch is only padded up to its longest sentence, so a batch never holds
+    more than batch_size sentences or more than max_batch_tokens padded tokens.
+    """
+
+    batches = []
+    batch = []
+
+    for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # indices are sorted on length, so the current sentence is the longest
+        if batch and (
+            len(batch) == batch_size
+            or (
+                max_batch_tokens is not None
+                and (len(batch) + 1) * lengths[index] > max_batch_tokens
+            )
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def predict_sentences(
+    pipe: pipeline,
+    sentences: list[str],
+    verbose=False,
+    batch_size: int = 1,
+    max_batch_tokens: int | None = None,
+    progress=True,
+) -> list[list[dict]]:
+    """Uses the model in pipeline to predict events in the sentences.
+    Returns a list per sentence containing a dict per event
+    """
+
+    if batch_size == 1:
+        predictions = []
+        for sentence in tqdm(
+            sentences, desc='sentences', leave=False, disable=not progress
+        ):
+            predictions.append(pipe(sentence))
+            if verbose:
+                tqdm.write(f'{sentence}\n{predictions[-1]}\n')
+
+        return predictions
+
+    # batch sentences of similar subword length and put them back in order
+    lengths = [
+        len(input_ids)
+        for input_ids in pipe.tokenizer(sentences, truncation=True)['input_ids']
+    ]
+
+    predictions = [None] * len(sentences)
+    for batch in tqdm(
+        batch_by_length(lengths, batch_size, max_batch_tokens),
+        desc='batches',
+        leave=False,
+        disable=not progress,
+    ):
+        batch_predictions = pipe(
+            [sentences[index] for index in batch], batch_size=len(batch)
+        )
+        for index, sentence_predictions in zip(batch, batch_predictions):
+            predictions[index] = sentence_predictions
+            if verbose:
+                tqdm.write(f'{sentences[index]}\n{sentence_predictions}\n')
+
+    return predictions
+
+
 def predict_novel_events(
-    pipe: pipeline, novel_filepath: str, verbose=False
+    pipe: pipeline,
+    novel_filepath: str,
+    verbose=False,
+    batch_size: int = 1,
+    max_batch_tokens: int | None = None,
+    progress=True,
 ) -> list[list[dict]]:
     """Uses the model in pipeline to predict events in the novel.
     Creates a list that has a list per sentence containing a dict per event
     """
 
-    predictions = []
-
     with open(novel_filepath, 'r', encoding='UTF-8') as inp:
-        novel_lines = inp.readlines()
+        sentences = [sentence.rstrip('\n') for sentence in inp.readlines()]
 
-    for sentence in tqdm(novel_lines, desc='sentences', leave=False):
-        predictions.append(pipe(sentence.rstrip('\n')))
-        if verbose:
-            tqdm.write(f'{sentence}{predictions[-1]}\n')
+    return predict_sentences(
+        pipe, sentences, verbose, batch_size, max_batch_tokens, progress
+    )
 
-    return predictions
+
+def stream_novel_events(
+    pipe: pipeline,
+    novel_filepath: str,
+    predictions_filepath: str,
+    chunk_size: int,
+    verbose=False,
+    batch_size: int = 1,
+    max_batch_tokens: int | None = None,
+    progress=True,
+) -> int:
+    """Predicts events in the novel chunk_size sentences at a time and appends
+    every chunk to the predictions file, so the novel is never fully in memory.
+
+    Chunks go to a .partial file, and a .checkpoint file records how many
+    sentences and bytes are finished. An interrupted novel continues from the
+    checkpoint, and the .partial file is renamed to predictions_filepath once
+    the whole novel is done. Use util.load_predictions to read the chunks.
+    Returns the number of sentences in the novel.
+    """
+
+    partial_filepath = predictions_filepath + '.partial'
+    checkpoint_filepath = predictions_filepath + '.checkpoint'
+
+    # resume from the checkpoint, dropping a chunk that was only half written
+    checkpoint = {'sentences': 0, 'bytes': 0}
+    if os.path.exists(checkpoint_filepath) and os.path.exists(partial_filepath):
+        with open(checkpoint_filepath, 'r', encoding='UTF-8') as inp:
+            checkpoint = json.load(inp)
+
+    with open(novel_filepath, 'r', encoding='UTF-8') as inp, open(
+        partial_filepath, 'ab'
+    ) as outp:
+        outp.truncate(checkpoint['bytes'])
+
+        lines = islice(inp, checkpoint['sentences'], None)
+        with tqdm(
+            desc='sentences',
+            initial=checkpoint['sentences'],
+            leave=False,
+            disable=not progress,
+        ) as sentence_progress:
+            while chunk := [line.rstrip('\n') for line in islice(lines, chunk_size)]:
+                pickle.dump(
+                    predict_sentences(
+                        pipe,
+                        chunk,
+                        verbose,
+                        batch_size,
+                        max_batch_tokens,
+                        progress=False,
+                    ),
+                    outp,
+                    pickle.HIGHEST_PROTOCOL,
+                )
+                outp.flush()
+                os.fsync(outp.fileno())
+
+                checkpoint['sentences'] += len(chunk)
+                checkpoint['bytes'] = outp.tell()
+                with open(checkpoint_filepath + '.tmp', 'w', encoding='UTF-8') as cp:
+                    json.dump(checkpoint, cp)
+                os.replace(checkpoint_filepath + '.tmp', checkpoint_filepath)
+
+                sentence_progress.update(len(chunk))
+
+    os.replace(partial_filepath, predictions_filepath)
+    if os.path.exists(checkpoint_filepath):
+        os.remove(checkpoint_filepath)
+
+    return checkpoint['sentences']
+
+
+def write_novel_events(
+    pipe: pipeline,
+    novel_filepath: str,
+    predictions_filepath: str,
+    chunk_size: int = 0,
+    columnar=False,
+    **kwargs,
+) -> int:
+    """Predicts events in the novel and writes them to the .predictions.pickle
+    file, streaming in chunks if chunk_size is set. If columnar is set, the
+    predictions are written to a prediction_store directory without .pickle
+    instead. Returns the number of sentences.
+    """
+
+    store_dirpath = predictions_filepath.removesuffix('.pickle')
+
+    if chunk_size:
+        sentence_count = stream_novel_events(
+            pipe, novel_filepath, predictions_filepath, chunk_size, **kwargs
+        )
+        if columnar:
+            save_predictions(iter_predictions(predictions_filepath), store_dirpath)
+            os.remove(predictions_filepath)
+
+        return sentence_count
+
+    novel_predictions = predict_novel_events(pipe, novel_filepath, **kwargs)
+    if columnar:
+        save_predictions(novel_predictions, store_dirpath)
+    else:
+        with open(predictions_filepath, 'wb') as outp:
+            pickle.dump(novel_predictions, outp, pickle.HIGHEST_PROTOCOL)
+
+    return len(novel_predictions)
+
+
+# every worker process loads its own pipeline once, see init_worker
+worker_pipe = None
+worker_settings = {}
+
+
+def init_worker(
+    model: str,
+    threads: int,
+    batch_size: int,
+    max_batch_tokens: int | None,
+    chunk_size: int,
+    columnar: bool,
+) -> None:
+    """Limits the threads of the worker process and loads the model on the CPU"""
+    global worker_pipe
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    worker_pipe = pipeline('token-classification', model, device=-1)
+    worker_settings.update(
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        chunk_size=chunk_size,
+        columnar=columnar,
+    )
+
+
+def predict_novel_worker(filepaths: tuple[str, str]) -> dict[str, int | float | str]:
+    """Predicts the events of one novel in a worker process, writes them to
+    the predictions file, and returns the throughput of the worker
+    """
+
+    novel_filepath, predictions_filepath = filepaths
+
+    start_time = time.perf_counter()
+    sentence_count = write_novel_events(
+        worker_pipe,
+        novel_filepath,
+        predictions_filepath,
+        progress=False,
+        **worker_settings,
+    )
+
+    return {
+        'worker': os.getpid(),
+        'novel': os.path.basename(novel_filepath),
+        'sentences': sentence_count,
+        'seconds': time.perf_counter() - start_time,
+    }
+
+
+def print_throughput(results: list[dict[str, int | float | str]]) -> None:
+    """Prints the number of novels and sentences per second of every worker"""
+
+    workers = {}
+    for result in results:
+        worker = workers.setdefault(
+            result['worker'], {'novels': 0, 'sentences': 0, 'seconds': 0.0}
+        )
+        worker['novels'] += 1
+        worker['sentences'] += result['sentences']
+        worker['seconds'] += result['seconds']
+
+    print('\nThroughput per worker:')
+    for pid, worker in sorted(workers.items()):
+        print(
+            f'worker {pid}: {worker["novels"]} novels | {worker["sentences"]} sentences'
+            f' | {worker["seconds"]:.1f}s'
+            f' | {worker["sentences"] / worker["seconds"] if worker["seconds"] else 0:.2f} sentences/s'
+        )
 
 
 def main(argv: list[str]) -> None:
     """Takes DBNL literary texts as input and uses model to predict events
     python3 predict_events.py model/ file_with_names_of_novels.txt
+    add --batch-size 32 [--max-batch-tokens 4096] to predict in batches
+    add --workers 8 [--threads-per-worker 4] to predict on a pool of CPU workers
+    add --chunk-size 1000 to stream long novels and resume them when interrupted
+    add --columnar to write the predictions as a store of typed columns
     """
 
     NOVEL_DIRECTORY = './data/novels/'
@@ -39,15 +384,10 @@ def main(argv: list[str]) -> None:
         False  # set to true to override predictions for novels that have predictions
     )
 
-    if len(argv) < 3:
-        print('provide a model and file containing filenames to predict')
-        return
-
-    # initialize model
-    pipe = pipeline('token-classification', argv[1], device=0)
+    args = parse_args(argv)
 
     # get filenames of novels to predict
-    with open(argv[2], 'r', encoding='UTF-8') as inp:
+    with open(args.filenames_filepath, 'r', encoding='UTF-8') as inp:
         filenames = [filename.rstrip() + '.tok' for filename in inp.readlines()]
 
     # filter out filenames that have a prediction already
@@ -56,22 +396,65 @@ def main(argv: list[str]) -> None:
             filename
             for filename in filenames
             if not os.path.exists(
-                NOVEL_DIRECTORY + filename.split('.')[0] + '.predictions.pickle'
+                NOVEL_DIRECTORY
+                + filename.split('.')[0]
+                + ('.predictions' if args.columnar else '.predictions.pickle')
+            )
+        ]
+
+    # let the workers take novels from a shared queue and write the predictions
+    if args.workers:
+        filepaths = [
+            (
+                NOVEL_DIRECTORY + filename,
+                NOVEL_DIRECTORY + filename.split('.')[0] + '.predictions.pickle',
             )
+            for filename in filenames
         ]
+        with Pool(
+            args.workers,
+            initializer=init_worker,
+            initargs=(
+                args.model,
+                args.threads_per_worker,
+                args.batch_size,
+                args.max_batch_tokens,
+                args.chunk_size,
+                args.columnar,
+            ),
+        ) as pool:
+            results = []
+            progress = tqdm(
+                pool.imap_unordered(predict_novel_worker, filepaths),
+                total=len(filepaths),
+                desc='novels',
+            )
+            for result in progress:
+                progress.set_postfix_str(result['novel'])
+                results.append(result)
+                invalidate_statistics(result['novel'].split('.')[0], NOVEL_DIRECTORY)
+
+        print_throughput(results)
+        return
+
+    # initialize model
+    pipe = pipeline('token-classification', args.model, device=0)
 
     # predict events in novels and write predictions to pickle files
     progress = tqdm(filenames, desc='novels')
     for filename in progress:
         progress.set_postfix_str(filename)
-        novel_predictions = predict_novel_events(
-            pipe, NOVEL_DIRECTORY + filename, verbose=False
-        )
-        predictions_filename = (
-            NOVEL_DIRECTORY + filename.split('.')[0] + '.predictions.pickle'
+        write_novel_events(
+            pipe,
+            NOVEL_DIRECTORY + filename,
+            NOVEL_DIRECTORY + filename.split('.')[0] + '.predictions.pickle',
+            chunk_size=args.chunk_size,
+            columnar=args.columnar,
+            verbose=False,
+            batch_size=args.batch_size,
+            max_batch_tokens=args.max_batch_tokens,
         )
-        with open(predictions_filename, 'wb') as outp:
-            pickle.dump(novel_predictions, outp, pickle.HIGHEST_PROTOCOL)
+        invalidate_statistics(filename.split('.')[0], NOVEL_DIRECTORY)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+"""Stores the event predictions of a novel as typed columns instead of a pickle
+of dicts, and converts existing .predictions.pickle files to this format.
+
+A store is a directory containing one .npy file per column, which can be
+memory-mapped, and two json string tables:
+    offsets.npy  -- int64, the tokens of sentence i are offsets[i]:offsets[i + 1]
+    index.npy    -- int32, subword index of the token in the sentence
+    label.npy    -- uint8, id of the entity in labels.json
+    score.npy    -- float32, score of the entity
+    start.npy    -- int32, start character index of the token in the sentence
+    end.npy      -- int32, end character index of the token in the sentence
+    word.npy     -- int32, id of the subword token in words.json
+"""
+import os
+import sys
+import json
+import shutil
+from array import array
+from collections.abc import Iterable
+import numpy as np
+from util import iter_predictions
+
+# the labels of the fine-tuned model, so label ids match the model's ids
+LABELS = ['O', 'nonrealis', 'realis']
+
+# column name -> (array typecode while writing, numpy dtype on disk)
+COLUMNS = {
+    'index': ('i', np.int32),
+    'label': ('B', np.uint8),
+    'score': ('f', np.float32),
+    'start': ('i', np.int32),
+    'end': ('i', np.int32),
+    'word': ('i', np.int32),
+}
+
+
+def save_predictions(predictions: Iterable[list[dict]], dirpath: str) -> None:
+    """Writes the predictions (a list per sentence containing a dict per event)
+    to a columnar store in dirpath. The predictions are only iterated once, so
+    they can be streamed with util.iter_predictions.
+    """
+
+    labels = {label: label_id for label_id, label in enumerate(LABELS)}
+    words = {}
+    offsets = array('q', [0])
+    columns = {name: array(typecode) for name, (typecode, _) in COLUMNS.items()}
+
+    for sentence in predictions:
+        for event in sentence:
+            columns['index'].append(event['index'])
+            columns['label'].append(labels.setdefault(event['entity'], len(labels)))
+            columns['score'].append(event['score'])
+            columns['start'].append(event['start'])
+            columns['end'].append(event['end'])
+            columns['word'].append(words.setdefault(event['word'], len(words)))
+        offsets.append(len(columns['index']))
+
+    # write to a temporary directory so a store is never half written
+    tmp_dirpath = dirpath + '.tmp'
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    os.makedirs(tmp_dirpath)
+
+    np.save(os.path.join(tmp_dirpath, 'offsets.npy'), np.frombuffer(offsets, np.int64))
+    for name, (_, dtype) in COLUMNS.items():
+        np.save(
+            os.path.join(tmp_dirpath, f'{name}.npy'),
+            np.frombuffer(columns[name], dtype),
+        )
+
+    with open(os.path.join(tmp_dirpath, 'labels.json'), 'w', encoding='UTF-8') as outp:
+        json.dump(list(labels), outp, ensure_ascii=False)
+    with open(os.path.join(tmp_dirpath, 'words.json'), 'w', encoding='UTF-8') as outp:
+        json.dump(list(words), outp, ensure_ascii=False)
+
+    shutil.rmtree(dirpath, ignore_errors=True)
+    os.replace(tmp_dirpath, dirpath)
+
+
+class PredictionStore:
+    """The event predictions of a novel, loaded from a columnar store.
+
+    :ivar offsets: the tokens of sentence i are offsets[i]:offsets[i + 1]
+    :ivar index, label, score, start, end, word: one array per column
+        with a value for every predicted token in the novel
+    :ivar labels: maps label ids to entity names
+    :ivar words: maps word ids to subword tokens
+    """
+
+    def __init__(self, dirpath: str, mmap_mode: str | None = 'r'):
+        """Loads (memory-maps by default) the columns of the store in dirpath"""
+        self.offsets = np.load(
+            os.path.join(dirpath, 'offsets.npy'), mmap_mode=mmap_mode
+        )
+        for name in COLUMNS:
+            setattr(
+                self,
+                name,
+                np.load(os.path.join(dirpath, f'{name}.npy'), mmap_mode=mmap_mode),
+            )
+
+        with open(os.path.join(dirpath, 'labels.json'), 'r', encoding='UTF-8') as inp:
+            self.labels = json.load(inp)
+        with open(os.path.join(dirpath, 'words.json'), 'r', encoding='UTF-8') as inp:
+            self.words = json.load(inp)
+
+    def __len__(self) -> int:
+        """Returns the number of sentences"""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, sentno: int) -> list[dict]:
+        """Returns the predictions of a sentence as the dicts of the pipeline"""
+        if not 0 <= sentno < len(self):
+            raise IndexError(f'sentence {sentno} is not in the store of {len(self)}')
+
+        return [
+            {
+                'entity': self.labels[self.label[token]],
+                'score': self.score[token],
+                'index': int(self.index[token]),
+                'word': self.words[self.word[token]],
+                'start': int(self.start[token]),
+                'end': int(self.end[token]),
+            }
+            for token in range(self.offsets[sentno], self.offsets[sentno + 1])
+        ]
+
+    def to_list(self) -> list[list[dict]]:
+        """Returns the predictions in the format of a .predictions.pickle file"""
+        return [self[sentno] for sentno in range(len(self))]
+
+    def label_counts(self) -> dict[str, int]:
+        """Counts the predicted tokens per entity without building dicts"""
+        counts = np.bincount(self.label, minlength=len(self.labels))
+        return dict(zip(self.labels, counts.tolist()))
+
+
+def main(argv: list[str]) -> None:
+    """Converts .predictions.pickle files to columnar stores next to them.
+    python3 prediction_store.py data/novels/*.predictions.pickle
+    """
+
+    if len(argv) < 2:
+        print('provide the .predictions.pickle files to convert', file=sys.stderr)
+        return
+
+    for filepath in argv[1:]:
+        if not filepath.endswith('.predictions.pickle'):
+            print(f'skipping {filepath}, not a .predictions.pickle file')
+            continue
+
+        dirpath = filepath.removesuffix('.pickle')
+        save_predictions(iter_predictions(filepath), dirpath)
+
+        store_size = sum(
+            entry.stat().st_size for entry in os.scandir(dirpath) if entry.is_file()
+        )
+        print(
+            f'{filepath} ({os.path.getsize(filepath) / 1e6:.1f} MB) -> '
+            f'{dirpath} ({store_size / 1e6:.1f} MB)'
+        )
+
+
+if __name__ == '__main__':
+    main(sys.argv)
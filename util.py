@@ -1,8 +1,15 @@
 """This file contains the code that can be used for other programs"""
 
 import re
+import sys
+import json
+import pickle
+from collections import defaultdict
+from collections.abc import Iterator
+from io import TextIOWrapper
 from pprint import pformat
 from enum import Enum
+from typing import NamedTuple
 
 
 class EventType(Enum):
@@ -41,138 +48,203 @@ class MentionType(Enum):
         raise ValueError('Could not convert the string to MentionType enum')
 
 
+def iter_predictions(filepath: str) -> Iterator[list[dict]]:
+    """Yields the event predictions of a novel per sentence from a
+    .predictions.pickle file. Also reads files written in chunks by
+    predict_events.py --chunk-size, holding only one chunk in memory.
+    """
+
+    with open(filepath, 'rb') as inp:
+        while True:
+            try:
+                yield from pickle.load(inp)
+            except EOFError:
+                return
+
+
+def load_predictions(filepath: str) -> list[list[dict]]:
+    """Loads the event predictions of a novel from a .predictions.pickle file"""
+
+    return list(iter_predictions(filepath))
+
+
+class Event(NamedTuple):
+    """An annotated event and the character span of its text in the sentence"""
+
+    type: EventType
+    separate_verb_particle: bool
+    span: tuple[int, int]
+
+
+class Mention(NamedTuple):
+    """An annotated agent or patient, the token indices of the events it is
+    related to, and the character span of its text in the sentence
+    """
+
+    type: MentionType
+    to_event: frozenset[tuple[int]]
+    span: tuple[int, int]
+
+
 class Annotation:
     """This contains all the information of an annotation for a sentence
     It can also export different information for different purposes.
+    Only the parsed fields are kept, not the annotation json itself.
     """
 
+    __slots__ = (
+        'author',
+        'title',
+        'sent_id',
+        'random_id',
+        'text',
+        'time_to_annotate',
+        'offsets',
+        'events',
+        'mentions',
+    )
+
     def __init__(self, annotation_json):
         """Sets all the annotation fields from the annotation json"""
-        self.full_json = annotation_json
 
-        # set annotation metadata
+        # set annotation metadata, the author and title are shared by many sentences
         metadata = annotation_json['data']
-        self.author = metadata['author']
-        self.title = metadata['title']
+        self.author = sys.intern(metadata['author'])
+        self.title = sys.intern(metadata['title'])
         self.sent_id = metadata['sentid']
+        self.random_id = metadata.get('randomid')
         self.text = metadata['text']
         # could also add context here
         self.time_to_annotate = annotation_json['annotations'][0]['lead_time']
 
+        # look up token indices of character spans without resplitting the text
+        self.offsets = self.char_tok_offsets(self.text)
+
         # set annotation data
         self.events, self.mentions = self.process_annotations(
             annotation_json['annotations'][0]['result']
         )
 
+        # the lookup table is only needed while processing the annotations
+        self.offsets = None
+
     def __str__(self) -> str:
-        """Returns a formatted string of the annotation json"""
+        """Returns a formatted string of the annotation"""
+
+        annotations = {
+            index: annotation._asdict() | {'text': self.span_text(annotation.span)}
+            for index, annotation in (self.events | self.mentions).items()
+        }
+
+        return f'{self.text}{pformat(annotations)}'
+
+    def span_text(self, span: tuple[int, int]) -> str:
+        """Returns the text of a character span of an event or mention"""
 
-        return f'{self.text}{pformat(self.events | self.mentions)}'
+        return self.text[span[0] : span[1]]
 
-    def process_annotations(self, annotations) -> tuple[dict, dict]:
-        """Formats the results of the annotation json into dicts with only
-        the required information
+    def process_annotations(
+        self, annotations
+    ) -> tuple[dict[tuple[int], Event], dict[tuple[int], Mention]]:
+        """Formats the results of the annotation json into events and mentions
+        with only the required information
         """
 
         events = dict()
         mentions = dict()
 
+        # index the results once, so every event only looks at its own relations
+        results_by_name = defaultdict(list)
+        relations_by_event = defaultdict(list)
+        for annotation in annotations:
+            results_by_name[annotation.get('from_name', '')].append(annotation)
+
+            # relations go from agent to event, and from event to patient
+            if 'to_id' in annotation:
+                relations_by_event[annotation['to_id']].append(
+                    (MentionType.AGENT, annotation['from_id'])
+                )
+            if 'from_id' in annotation:
+                relations_by_event[annotation['from_id']].append(
+                    (MentionType.PATIENT, annotation['to_id'])
+                )
+
         all_mentions = {
-            annotation['id']: annotation
-            for annotation in annotations
-            if annotation.get('from_name', '') == 'entities'
+            annotation['id']: annotation for annotation in results_by_name['entities']
+        }
+        sep_verb_particle_ids = {
+            annotation['id'] for annotation in results_by_name['sep_verb_particle']
         }
 
         # ignore events that are actually mentions
+        mention_events = defaultdict(set)
         for event in [
-            ann
-            for ann in annotations
-            if ann.get('from_name', '') == 'event' and 'mention' not in ann['id']
+            ann for ann in results_by_name['event'] if 'mention' not in ann['id']
         ]:
             # print(annotation['value']['text'])
-            event_tok_idx = self.char_tok_idx(
-                event['value']['start'], event['value']['end'], self.text
+            span = (event['value']['start'], event['value']['end'])
+            event_tok_idx = self.char_tok_idx(*span, self.text)
+            events[event_tok_idx] = Event(
+                EventType.from_str(event['value']['labels'][0]),
+                event['id'] in sep_verb_particle_ids,
+                span,
+            )
+
+            # add the agents and patients related to the event
+            for mention_type, mention_id in relations_by_event[event['id']]:
+                span = (
+                    all_mentions[mention_id]['value']['start'],
+                    all_mentions[mention_id]['value']['end'],
+                )
+                mention_tok_idx = self.char_tok_idx(*span, self.text)
+
+                # the first relation of a mention sets its type and span
+                if mention_tok_idx not in mentions:
+                    mentions[mention_tok_idx] = Mention(mention_type, frozenset(), span)
+                mention_events[mention_tok_idx].add(event_tok_idx)
+
+        mentions = {
+            mention_tok_idx: mention._replace(
+                to_event=frozenset(mention_events[mention_tok_idx])
             )
-            events[event_tok_idx] = {
-                'type': EventType.from_str(event['value']['labels'][0]),
-                'separate_verb_particle': False,
-                'text': event['value']['text'],
-            }
-            for annotation in annotations:
-                # check for related sep verb particle
-                if (
-                    annotation.get('from_name', '') == 'sep_verb_particle'
-                    and annotation['id'] == event['id']
-                ):
-                    events[event_tok_idx]['separate_verb_particle'] = True
-
-                # check for related agents (annotation is a relation, going from agent to event)
-                if annotation.get('to_id', '') == event['id']:
-                    mention_tok_idx = self.char_tok_idx(
-                        all_mentions[annotation['from_id']]['value']['start'],
-                        all_mentions[annotation['from_id']]['value']['end'],
-                        self.text,
-                    )
-
-                    mentions[mention_tok_idx] = mentions.get(
-                        mention_tok_idx,
-                        {
-                            'type': MentionType.AGENT,
-                            'to_event': set(),
-                            'text': all_mentions[annotation['from_id']]['value'][
-                                'text'
-                            ],
-                        },
-                    )
-                    mentions[mention_tok_idx]['to_event'].add(event_tok_idx)
-
-                # check for related patients (annotation is a relation, going from event to patient)
-                if annotation.get('from_id', '') == event['id']:
-                    # print(annotation1, annotation['id'])
-                    mention_tok_idx = self.char_tok_idx(
-                        all_mentions[annotation['to_id']]['value']['start'],
-                        all_mentions[annotation['to_id']]['value']['end'],
-                        self.text,
-                    )
-                    mentions[mention_tok_idx] = mentions.get(
-                        mention_tok_idx,
-                        {
-                            'type': MentionType.PATIENT,
-                            'to_event': set(),
-                            'text': all_mentions[annotation['to_id']]['value']['text'],
-                        },
-                    )
-                    mentions[mention_tok_idx]['to_event'].add(event_tok_idx)
+            for mention_tok_idx, mention in mentions.items()
+        }
 
         return events, mentions
 
-    def char_tok_idx(
-        self, start_char_idx: int, end_char_idx: int, text: str
-    ) -> tuple[int]:
-        """Changes character based index into token based index"""
+    @staticmethod
+    def char_tok_offsets(text: str) -> tuple[dict[int, int], dict[int, int]]:
+        """Maps the start and the end character index of every token in the
+        text to the index of the token
+        """
         # replace characters that are not selected
         text = text.replace('-', ' ').replace("'", ' ')
 
-        text_list = [token + ' ' for token in text.split(' ')]
-
-        start_idx = None
+        starts, ends = {}, {}
         char_count = 0
-        for idx, token in enumerate(text_list):
-            if (  # it is just one token
-                char_count == start_char_idx
-                and char_count + len(token.rstrip()) == end_char_idx
-            ):
-                return tuple([idx])
+        for idx, token in enumerate(text.split(' ')):
+            starts[char_count] = idx
+            ends[char_count + len(token.rstrip())] = idx
+            char_count += len(token) + 1
 
-            if char_count == start_char_idx:  # the start of a multi-token sequence
-                start_idx = idx
+        return starts, ends
 
-            if start_idx is not None:  # check for the end of a multi-token sequence
-                if char_count + len(token.rstrip()) == end_char_idx:
-                    return tuple(range(start_idx, idx + 1))
+    def char_tok_idx(
+        self, start_char_idx: int, end_char_idx: int, text: str
+    ) -> tuple[int]:
+        """Changes character based index into token based index"""
+        starts, ends = (
+            self.offsets
+            if self.offsets is not None and text == self.text
+            else self.char_tok_offsets(text)
+        )
 
-            char_count += len(token)
+        start_idx = starts.get(start_char_idx)
+        end_idx = ends.get(end_char_idx)
+        if start_idx is not None and end_idx is not None and start_idx <= end_idx:
+            return tuple(range(start_idx, end_idx + 1))
 
+        text = text.replace('-', ' ').replace("'", ' ')
         raise IndexError(
             'Could not line up the start/end char index with index of a token in text'
             f'\ntext: {text}, start_idx: {start_char_idx} - end_idx: {end_char_idx} selection: {text[start_char_idx:end_char_idx+1]}'
@@ -192,17 +264,15 @@ class Annotation:
         if not only_mentions:
             for index, event in self.events.items():
                 if no_sep_particle:
-                    annotations.add((index, event['type']))
+                    annotations.add((index, event.type))
                 else:
-                    annotations.add(
-                        (index, event['type'], event['separate_verb_particle'])
-                    )
+                    annotations.add((index, event.type, event.separate_verb_particle))
 
         # add mentions if they should be, add a separate mention for every event
         if not only_events:
             for index, mention in self.mentions.items():
-                for event in mention['to_event']:
-                    annotations.add((index, mention['type'], event))
+                for event in mention.to_event:
+                    annotations.add((index, mention.type, event))
 
         return annotations
 
@@ -218,11 +288,56 @@ class Annotation:
             labels.append(0)
             for event_idx, event in self.events.items():
                 if token_idx in event_idx:
-                    labels[token_idx] = event['type'].value
+                    labels[token_idx] = event.type.value
 
         return {'event_tags': labels, 'tokens': tokens}
 
 
+# label_studio/formatting_scripts/util.py has a copy for the Label Studio
+# scripts, which run in their own environment and cannot import this module
+def iter_tasks(file: TextIOWrapper, chunk_size: int = 1 << 16) -> Iterator[dict]:
+    """Yields the tasks of a Label Studio json export one at a time, parsing
+    the top-level array in chunks instead of loading the whole file
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('The Label Studio export should be a json array of tasks')
+
+    position = 1
+    end_of_file = False
+    while True:
+        # skip the separators between tasks
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        if position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            task, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if end_of_file:
+                raise
+
+            # the task is not complete yet, so read (more and more) of the file
+            chunk = file.read(max(chunk_size, len(buffer) - position))
+            end_of_file = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield task
+
+
+def iter_annotations(file: TextIOWrapper) -> Iterator[Annotation]:
+    """Yields an Annotation per task of a Label Studio json export"""
+
+    for task in iter_tasks(file):
+        yield Annotation(task)
+
+
 def main(argv: list[str]) -> None:
     """Main function for debugging Currently prints all annotations from a file"""
 
@@ -231,16 +346,9 @@ def main(argv: list[str]) -> None:
         return
 
     with open(argv[1], 'r', encoding='UTF-8') as inp:
-        annotations_json = json.load(inp)
-
-    annotations = [Annotation(annotation) for annotation in annotations_json]
-
-    for annotation in annotations:
-        print(annotation, end='\n\n')
+        for annotation in iter_annotations(inp):
+            print(annotation, end='\n\n')
 
 
 if __name__ == '__main__':
-    import sys
-    import json
-
     main(sys.argv)